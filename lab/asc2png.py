@@ -1,54 +1,129 @@
+import math
 import os
-import tkinter as tk
-from tkinter.filedialog import askopenfilenames
-
-import seaborn as sns
-from matplotlib import pyplot as plt
-
-
-def makeXY(file):
-    lines = []
-    with open(file, "r") as f:
-        for line in f:
-            y = line.split()
-            lines.append(y)
-    lines = lines[:-1]
-    for j in lines:
-        number = float(j[0][:-6])
-        exponent = int(j[0][-1])
-        newNumber = number * 10**exponent
-        j[0] = newNumber
-        j[1] = int(j[1])
-    x = [x[0] for x in lines]
-    y = [x[1] for x in lines]
-    return x, y
-
-
-def main():
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import click
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+from waxsplot import RENDER_FORMATS, decimate, get_canvas
+from waxsreaders import *
+
+# Size of one scan on the contact sheet in inches
+TILE = (3, 2)
+
+
+def render_file(file: str, dpi: int = 300, fmt: str = "png"):
+    x, y = read_xy(file)
+    canvas = get_canvas()
+    name = os.path.splitext(file)[0]
+    ax = canvas.start(os.path.split(name)[1], "2Θ", "intensity")
+    canvas.line(x, y)
+    ax.set_xlim(min(x), max(x))
+    ax.set_ylim(min(y), max(y))
+    canvas.save(f"{name}.{fmt}", dpi=dpi)
+    return file
+
+
+def load_thumbnail(file: str, width: int):
+    title = os.path.splitext(os.path.split(file)[1])[0]
+    try:
+        x, y = read_xy(file)
+    except ValueError:
+        return title, None, None
+    return title, *decimate(x, y, width)
+
+
+def render_sheet(files: list, path: str, columns: int, jobs: int, dpi: int):
+    # All scans go into one line collection on a single axes, tile by tile
+    rows = math.ceil(len(files) / columns)
+    figure = Figure(figsize=(columns * TILE[0], rows * TILE[1]))
+    FigureCanvasAgg(figure)
+    ax = figure.add_axes((0, 0, 1, 1))
+    ax.set_xlim(0, columns)
+    ax.set_ylim(rows, 0)
+    ax.axis("off")
+    ax.vlines(range(1, columns), 0, rows, colors="0.8", linewidth=0.5)
+    ax.hlines(range(1, rows), 0, columns, colors="0.8", linewidth=0.5)
+
+    load = partial(load_thumbnail, width=int(TILE[0] * dpi * 0.9))
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            chunk = max(1, len(files) // (jobs * 4))
+            scans = list(pool.map(load, files, chunksize=chunk))
+    else:
+        scans = list(map(load, files))
+    segments = []
+    for num, (title, x, y) in enumerate(scans):
+        row, col = divmod(num, columns)
+        ax.text(col + 0.05, row + 0.05, title, fontsize=5, va="top")
+        if x is None:
+            ax.text(col + 0.5, row + 0.6, "unreadable", ha="center", color="r")
+            continue
+        x_span = np.ptp(x) or 1
+        y_span = np.ptp(y) or 1
+        tile_x = col + 0.05 + 0.9 * (x - x.min()) / x_span
+        tile_y = row + 0.95 - 0.75 * (y - y.min()) / y_span
+        segments.append(np.column_stack((tile_x, tile_y)))
+    ax.add_collection(LineCollection(segments, colors="k", linewidths=0.5))
+    figure.savefig(path, dpi=dpi)
+
+
+def ask_files():
+    import tkinter as tk
+    from tkinter.filedialog import askopenfilenames
+
     root = tk.Tk()
     root.withdraw()
-    files = askopenfilenames(
+    return askopenfilenames(
         title="Select the ASC files with RTG data.", filetypes=[("ASC files", ".asc")]
     )
 
-    # Make a simple graphs from asc data
-    for iNum, file in enumerate(files, 1):
-        print(f"Working on file {iNum} out of {len(files)}")
-        x, y = makeXY(file)
-        sns.set_theme()
-        sns.set_style("whitegrid")
-        plt.plot(x, y, "k")
-        plt.xlim(min(x), max(x))
-        plt.ylim(min(y), max(y))
-        plt.title(os.path.split(file)[1][:-4])
-        plt.xlabel("2Θ")
-        plt.ylabel("intensity")
-        # mng = plt.get_current_fig_manager()
-        # mng.window.state("zoomed")
-        # plt.show()
-        plt.gcf().set_size_inches(16, 9)
-        plt.savefig(f"{file[:-3]}png", dpi=300)
-        plt.close()
+
+@click.command()
+@click.argument("paths", nargs=-1)
+@click.option(
+    "--jobs",
+    "-j",
+    default=os.cpu_count(),
+    type=click.IntRange(min=1),
+    help="Number of worker processes.",
+)
+@click.option("--dpi", type=int, help="Resolution, 300 for graphs, 100 for sheets.")
+@click.option(
+    "--format",
+    "fmt",
+    default="png",
+    type=click.Choice(RENDER_FORMATS),
+    help="File format of the graphs.",
+)
+@click.option("--sheet", help="Tile all scans into this one overview image instead.")
+@click.option("--columns", default=6, help="Scans per row of the overview image.")
+def main(paths, jobs, dpi, fmt, sheet, columns):
+    """Make simple graphs from ASC files (or folders and globs of them).
+    Without PATHS the files are picked in a dialog."""
+    files = find_files(paths) if paths else ask_files()
+    if not files:
+        print("No ASC files found")
+        sys.exit(2)
+    if sheet:
+        render_sheet(files, sheet, columns, jobs, dpi or 100)
+        print(f"{len(files)} scans saved to {sheet}")
+        return
+    render = partial(render_file, dpi=dpi or 300, fmt=fmt)
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            done = pool.map(render, files)
+            for iNum, file in enumerate(done, 1):
+                print(f"Done file {iNum} out of {len(files)}")
+    else:
+        for iNum, file in enumerate(files, 1):
+            print(f"Working on file {iNum} out of {len(files)}")
+            render(file)
 
 
 if __name__ == "__main__":
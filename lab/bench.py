@@ -0,0 +1,504 @@
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import click
+import numpy as np
+from scipy import sparse
+from openpyxl import Workbook
+from openpyxl.styles import PatternFill
+from openpyxl.utils import get_column_letter
+from scipy.sparse.linalg import spsolve
+from shapely.geometry import Polygon
+
+import cti2xlsx
+import dsc_eval
+from ctiparse import read_cti, read_prn
+from pb_blends import Group, Sample, closed_area, make_groups
+from waxsreaders import *
+
+
+def time_call(func, *args, repeat: int = 5):
+    best = float("inf")
+    for _ in range(repeat):
+        t_start = perf_counter()
+        result = func(*args)
+        best = min(best, perf_counter() - t_start)
+    return best, result
+
+
+@click.group()
+def cli():
+    pass
+
+
+@click.command()
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--repeat", "-r", default=5, help="Best of how many runs to report")
+def waxs_parse(files, repeat):
+    """Time the WAXS readers on existing data files"""
+    totals = {}
+    for file in files:
+        filetype = detect_format(file)
+        t_best, (x, y) = time_call(FORMATS[filetype], file, repeat=repeat)
+        totals.setdefault(filetype, []).append(t_best)
+        print(f"{filetype:<6} {len(y):>8} points {t_best * 1000:>9.3f} ms  {file}")
+    print("------------------------------------------------------")
+    for filetype, times in totals.items():
+        average = sum(times) / len(times) * 1000
+        print(f"{filetype:<6} {len(times):>5} files {average:>9.3f} ms per file")
+
+
+def baseline_spsolve(y, lam=10000, p=0.0001, niter=100):
+    # The original pb_blends baseline, kept as the reference
+    L = len(y)
+    D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(L, L - 2))
+    w = np.ones(L)
+    for i in range(niter):
+        W = sparse.spdiags(w, 0, L, L)
+        Z = W + lam * D.dot(D.transpose())
+        z = spsolve(Z.tocsc(), w * y)
+        w = p * (y > z) + (1 - p) * (y < z)
+    return z
+
+
+@click.command()
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--repeat", "-r", default=3, help="Best of how many runs to report")
+def baseline(files, repeat):
+    """Compare the old and new pb_blends baseline on existing data files"""
+    t_old_total = 0
+    t_new_total = 0
+    for file in files:
+        sample = Sample(file)
+        sample.get_xy()
+        sample.align()
+        sample.remove_air()
+        y = np.asarray(sample.y, dtype=float)
+        t_old, z_old = time_call(baseline_spsolve, y, repeat=repeat)
+        t_new, _ = time_call(sample.get_baseline, repeat=repeat)
+        t_old_total += t_old
+        t_new_total += t_new
+        difference = np.max(np.abs(sample.baseline - z_old))
+        print(
+            f"{t_old * 1000:>9.2f} ms -> {t_new * 1000:>7.2f} ms"
+            f"  max diff {difference:.2e}  {file}"
+        )
+    print("------------------------------------------------------")
+    print(f"Speedup: {round(t_old_total / t_new_total, 1)}x over {len(files)} files")
+
+
+def remove_air_loop(y):
+    # The original pb_blends air line removal, kept as the reference
+    y_air = np.linspace(y[0], y[-1], num=len(y))
+    while True:
+        difs = []
+        for i in range(0, len(y)):
+            dif = y[i] - y_air[i]
+            difs.append(dif)
+        if all(i >= 0 for i in difs):
+            break
+        else:
+            for j in range(0, len(y_air)):
+                y_air[j] -= 1
+    y_no_air = []
+    for i in range(0, len(y)):
+        y_no_air.append(y[i] - y_air[i])
+    return y_no_air, y_air
+
+
+def random_scans(count: int, points: int = 500):
+    # Bumpy series with the air line cutting through: integer and float counts,
+    # and sub-unit intensities rounded to 10 decimals like the itx reader gives
+    rng = np.random.default_rng(0)
+    x = np.linspace(5, 30, points)
+    for num in range(count):
+        if num % 3 == 2:
+            y = 0.5 + 0.2 * np.sin(x * rng.uniform(0.5, 3))
+            y += rng.normal(0, 0.05, points)
+            y[rng.integers(points, size=5)] -= rng.uniform(0, 5)
+            yield x, np.round(y, 10).tolist()
+            continue
+        y = 1000 + 50 * np.sin(x * rng.uniform(0.5, 3)) + rng.normal(0, 20, points)
+        y[rng.integers(points, size=5)] -= rng.uniform(0, 200)
+        yield x, (np.round(y) if num % 3 else y).tolist()
+
+
+@click.command()
+@click.argument("files", nargs=-1, type=click.Path(exists=True))
+@click.option("--random", "count", default=300, help="Number of random series")
+@click.option("--tolerance", default=1e-9, help="Largest difference to the old loop")
+def air(files, count, tolerance):
+    """Check the new pb_blends air line removal against the old loop"""
+    scans = []
+    for file in files:
+        sample = Sample(file)
+        sample.get_xy()
+        scans.append((file, np.asarray(sample.y).tolist()))
+    scans += [(f"random {num}", y) for num, (_, y) in enumerate(random_scans(count))]
+    exact = 0
+    worst = 0
+    for name, y in scans:
+        y_old, air_old = remove_air_loop(y)
+        sample = Sample(name)
+        sample.y = y
+        sample.remove_air()
+        # The old loop lowered the line by 1 at a time, which rounds a little
+        # differently from lowering it once by the whole offset
+        difference = max(
+            np.max(np.abs(sample.y - y_old)), np.max(np.abs(sample.air_line - air_old))
+        )
+        if difference > tolerance:
+            print(f"Differs by {difference:.1e}: {name}")
+        exact += difference == 0
+        worst = max(worst, difference)
+    print(f"{exact} of {len(scans)} scans match exactly")
+    print(f"Largest difference to the old loop {worst:.1e}")
+    if worst > tolerance:
+        sys.exit(1)
+
+
+def polygon_area(x, y):
+    # The original pb_blends crystallinity area, kept as the reference
+    points = [[x[i], y[i]] for i in range(0, len(x))]
+    points.append([x[0], y[0]])
+    return Polygon(points).area
+
+
+@click.command()
+@click.argument("files", nargs=-1, type=click.Path(exists=True))
+@click.option("--random", "count", default=100, help="Number of random curves")
+@click.option("--tolerance", default=1e-10, help="Largest relative difference")
+def crystallinity(files, count, tolerance):
+    """Check the pb_blends trapezoid areas against shapely polygons"""
+    curves = []
+    for file in files:
+        sample = Sample(file)
+        sample.get_xy()
+        sample.align()
+        sample.remove_air()
+        sample.get_baseline()
+        curves += [(file, sample.x, sample.y), (file, sample.x, sample.baseline)]
+    rng = np.random.default_rng(0)
+    for num in range(count):
+        # Unsorted x makes the curves cross themselves
+        x = rng.uniform(5, 30, 500) if num % 2 else np.linspace(5, 30, 500)
+        curves.append((f"random {num}", x, rng.normal(1000, 300, 500)))
+    worst = 0
+    for name, x, y in curves:
+        old = polygon_area(x, y)
+        difference = abs(closed_area(x, y) - old) / old
+        if difference > tolerance:
+            print(f"Area differs by {difference:.1e}: {name}")
+        worst = max(worst, difference)
+    print(f"{len(curves)} curves, largest relative difference {worst:.1e}")
+    if worst > tolerance:
+        sys.exit(1)
+
+
+def make_groups_scan(files: list):
+    # The original pb_blends grouping, kept as the reference
+    groups = []
+    for file in files:
+        file_name = os.path.split(file)[1]
+        file_split = file_name.split(" ")
+        code = file_split[0]
+        name_split = file_split[1:-6]
+        name = " ".join(str(x) for x in name_split)
+        name += " %"
+        if not any(group.code == code for group in groups):
+            groups.append(Group(code, name))
+        group_obj = [group for group in groups if group.code == code][0]
+        group_obj.add_sample(Sample(file))
+    return groups
+
+
+@click.command()
+@click.option("--files", "-n", default=50000, help="Number of synthetic files")
+@click.option("--groups", "-g", default=2500, help="Number of sample codes")
+@click.option("--repeat", "-r", default=1, help="Best of how many runs to report")
+def groups(files, groups, repeat):
+    """Compare the old and new pb_blends grouping on a synthetic listing"""
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for num in range(files):
+            code = num % groups
+            hours = num // groups
+            name = (
+                f"S{code} PB {code % 100} melt 01.01.2024 00.00 "
+                f"meas {1 + hours // 24:02}.01.2024 {hours % 24:02}.00.asc"
+            )
+            paths.append(os.path.join(folder, name))
+            with open(paths[-1], "w") as f:
+                f.write("1.00000000000000E+0001  100\n")
+        t_old, old = time_call(make_groups_scan, paths, repeat=repeat)
+        t_new, (new, malformed) = time_call(make_groups, paths, repeat=repeat)
+    same = [(g.code, len(g.samples)) for g in old] == [
+        (g.code, len(g.samples)) for g in new
+    ]
+    print(f"{files} files in {groups} groups, same groups: {same}")
+    print(f"{t_old:>9.2f} s -> {t_new:>7.2f} s  ({len(malformed)} malformed)")
+    print(f"Speedup: {round(t_old / t_new, 1)}x")
+
+
+def write_dsc_export(path: str, points: int):
+    # Heating, cooling and heating curves laid out like the DSC text exports
+    rng = np.random.default_rng(0)
+    segments = [(25, 300, -1), (300, 25, 1), (25, 300, -1)]
+    with open(path, "w") as f:
+        f.write("Sample: synthetic\n\n")
+        for num, (t_start, t_end, sign) in enumerate(segments, 1):
+            t = np.linspace(t_start, t_end, points)
+            peak = sign * 3 * np.exp(-(((t - 120 - 40 * num) / 3) ** 2))
+            value = 0.01 * t + peak + rng.normal(0, 0.01, points)
+            seconds = np.arange(points) * 6 * abs(t_end - t_start) / (points - 1)
+            rows = np.column_stack((np.arange(points), seconds, t, value))
+            f.write(f"Curve Name:\n  Segment {num}\nCurve Values:\n")
+            f.write("  Index      t      Ts   Value\n")
+            f.write("            [s]    [°C]  [W/g]\n")
+            text = "\n".join(
+                f"{int(i):>7} {a:>12.3f} {b:>12.3f} {c:>12.5f}"
+                for i, a, b, c in rows
+            )
+            f.write(text.replace(".", ",") + "\n\n")
+            f.write("Results:\n  Peak  123,4 °C\n\n")
+
+
+def read_curves_split(path: str):
+    # The original dsc_eval parsing, kept as the reference
+    with open(path) as f:
+        lines = f.read().replace(",", ".").splitlines()
+    start_lines = []
+    end_lines = []
+    for index, line in enumerate(lines):
+        if "Curve Values:" in line:
+            start_lines.append(index + 3)
+        if "Results:" in line:
+            end_lines.append(index - 2)
+    curves = []
+    for start, end in zip(start_lines, end_lines):
+        curve = np.array(
+            [
+                [i.split()[2], i.split()[3]]
+                for i in lines[start:end]
+                if 50 < float(i.split()[2]) < 275
+            ]
+        ).astype(float)
+        curves.append((curve.T[0], curve.T[1]))
+    return curves
+
+
+@click.command()
+@click.option("--points", "-n", default=200000, help="Points in each of the curves")
+@click.option("--repeat", "-r", default=3, help="Best of how many runs to report")
+def dsc(points, repeat):
+    """Compare the old and new dsc_eval parsing on a synthetic export"""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "export.txt")
+        write_dsc_export(path, points)
+        size = os.path.getsize(path) / 1024**2
+        t_old, old = time_call(read_curves_split, path, repeat=repeat)
+        t_new, new = time_call(dsc_eval.read_curves, path, repeat=repeat)
+    same = all(
+        np.array_equal(x_old, x_new) and np.array_equal(y_old, y_new)
+        for (x_old, y_old), (_, x_new, y_new) in zip(old, new)
+    )
+    print(f"3 curves of {points} points, {size:.1f} MB, same values: {same}")
+    print(f"{t_old * 1000:>9.1f} ms -> {t_new * 1000:>7.1f} ms")
+    print(f"Speedup: {round(t_old / t_new, 1)}x")
+
+
+def write_cti(path: str, points: int):
+    # S11, S21, S12 and S22 blocks of a VNA sweep in the CITI layout
+    rng = np.random.default_rng(0)
+    freq = np.linspace(8 * 10**9, 12 * 10**9, points).astype(np.int64)
+    with open(path, "w") as f:
+        f.write(f"CITIFILE A.01.00\nNAME MEAS\nVAR FREQ MAG {points}\n")
+        for name in ("S[1,1]", "S[2,1]", "S[1,2]", "S[2,2]"):
+            f.write(f"DATA {name} DB\n")
+        f.write("VAR_LIST_BEGIN\n" + "\n".join(map(str, freq)) + "\nVAR_LIST_END\n")
+        for level in (-10, -30, -30, -10):
+            values = level + rng.normal(0, 1, (points, 2))
+            f.write("BEGIN\n")
+            f.write("\n".join(f"{a:.6E},{b:.6E}" for a, b in values))
+            f.write("\nEND\n")
+
+
+def write_xlsx_cells(path: str, name: str, cti: list):
+    # The original cti2xlsx writing of the cti sheet, cell by cell with a new
+    # fill for every coloured cell, kept as the reference
+    wb = Workbook()
+    ws_cti = wb.active
+    ws_cti.title = "cti data"
+    ws_cti["A1"].value = name
+    letters = [get_column_letter(col) for col in range(1, 19)]
+    for letter, header in zip(letters, cti2xlsx.CTI_HEADERS):
+        ws_cti[letter + "2"].value = header
+    last_ghz = str(int(cti[0][0]))[:-9]
+    for i in range(len(cti[0])):
+        ghz = str(int(cti[0][i]))[:-9]
+        for letter, value, color in zip(
+            letters, cti2xlsx.CTI_COLUMNS, cti2xlsx.CTI_FILLS
+        ):
+            if isinstance(value, str):
+                ws_cti[letter + str(i + 3)].value = value.format(r=i + 3)
+            else:
+                ws_cti[letter + str(i + 3)].value = cti[value][i]
+            if ghz != last_ghz:
+                color = cti2xlsx.COL_ALR
+            if color:
+                ws_cti[letter + str(i + 3)].fill = PatternFill(
+                    fgColor=color[1:], fill_type="solid"
+                )
+        last_ghz = ghz
+    wb.save(path)
+    wb.close()
+
+
+@click.command()
+@click.option("--points", "-n", default=50000, help="Frequency points of the sweep")
+@click.option("--repeat", "-r", default=1, help="Best of how many runs to report")
+def cti(points, repeat):
+    """Compare the old and new cti2xlsx writing on a synthetic sweep"""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "sweep.cti")
+        write_cti(path, points)
+        data = cti2xlsx.cti_columns(path)
+        old = os.path.join(folder, "old.xlsx")
+        new = os.path.join(folder, "new.xlsx")
+        t_old, _ = time_call(write_xlsx_cells, old, "sweep", data, repeat=repeat)
+        t_new, _ = time_call(cti2xlsx.write_xlsx, new, "sweep", data, repeat=repeat)
+        size_old = os.path.getsize(old) / 1024**2
+        size_new = os.path.getsize(new) / 1024**2
+        t_values, _ = time_call(
+            lambda: cti2xlsx.write_xlsx(
+                new, "sweep", data, table=cti2xlsx.shielding_table(data)
+            ),
+            repeat=repeat,
+        )
+    print(f"{points} points, {size_old:.1f} MB -> {size_new:.1f} MB")
+    print(f"{t_old:>9.2f} s -> {t_new:>7.2f} s")
+    print(f"Speedup: {round(t_old / t_new, 1)}x")
+    print(f"Computed values instead of formulas: {t_values:.2f} s")
+
+
+def read_cti_lines(path: str):
+    # The original cti2xlsx parsing of four blocks, kept as the reference,
+    # with the second value of each line that it used to drop
+    with open(path) as f:
+        lines = f.read().splitlines()
+    start = lines.index("VAR_LIST_BEGIN") + 1
+    end = lines.index("VAR_LIST_END")
+    freq = [float(line) for line in lines[start:end]]
+    blocks = []
+    for _ in range(4):
+        start = lines.index("BEGIN", end) + 1
+        end = lines.index("END", start)
+        block = [[float(v) for v in line.split(",")] for line in lines[start:end]]
+        blocks.append(block)
+    return freq, blocks
+
+
+def read_prn_lines(path: str):
+    # The original cti2xlsx parsing of prn columns, kept as the reference
+    with open(path) as f:
+        lines = f.read().splitlines()
+    columns = []
+    for n in range(len(lines[3].split())):
+        columns.append([line.split()[n] for line in lines[3:]])
+    for column in columns:
+        for j in range(1, len(column)):
+            column[j] = float(column[j])
+    return columns
+
+
+def write_prn(path: str, points: int):
+    rng = np.random.default_rng(0)
+    with open(path, "w") as f:
+        f.write("Title\nDate\n\nPoint Freq Power Loss\n")
+        for num in range(1, points + 1):
+            power, loss = rng.normal(-3, 1), rng.uniform(0, 5)
+            f.write(f"{num} {8e9 + num * 1e6:.4E} {power:.3f} {loss:.2f}\n")
+
+
+# Small CITI files with the layouts the old parser could not read, the
+# expected number of blocks and points or None when reading must fail
+CTI_CASES = {
+    "six blocks": (
+        "VAR FREQ MAG 2\nDATA A RI\nDATA B RI\nVAR_LIST_BEGIN\n1\n2\nVAR_LIST_END\n"
+        + "BEGIN\n1,2\n3,4\nEND\n" * 6,
+        (6, 2),
+    ),
+    "single values": (
+        "VAR_LIST_BEGIN\n1\n2\n3\nVAR_LIST_END\nBEGIN\n1\n2\n3\nEND\n",
+        (1, 3),
+    ),
+    "segment sweep": (
+        "SEG_LIST_BEGIN\nSEG 8E9 12E9 4\nSEG_LIST_END\n"
+        "BEGIN\n1,2\n3,4\n5,6\n7,8\nEND\n",
+        (1, 4),
+    ),
+    "crlf": (
+        "VAR_LIST_BEGIN\r\n1\r\n2\r\nVAR_LIST_END\r\nBEGIN\r\n1,2\r\n3,4\r\nEND\r\n",
+        (1, 2),
+    ),
+    "unterminated": ("VAR_LIST_BEGIN\n1\nVAR_LIST_END\nBEGIN\n1,2\n", None),
+    "ragged": (
+        "VAR_LIST_BEGIN\n1\n2\n3\nVAR_LIST_END\nBEGIN\n1,2\n3\n4,5,6\nEND\n",
+        None,
+    ),
+}
+
+
+@click.command("ctiparse")
+@click.option("--points", "-n", default=50000, help="Frequency points of the sweep")
+@click.option("--repeat", "-r", default=3, help="Best of how many runs to report")
+def cti_parse(points, repeat):
+    """Check ctiparse against the old cti2xlsx parsing and on odd layouts"""
+    failed = 0
+    with tempfile.TemporaryDirectory() as folder:
+        cti_path = os.path.join(folder, "sweep.cti")
+        prn_path = os.path.join(folder, "sweep-prn.prn")
+        write_cti(cti_path, points)
+        write_prn(prn_path, points)
+        t_old, (freq, blocks) = time_call(read_cti_lines, cti_path, repeat=repeat)
+        t_new, cti = time_call(read_cti, cti_path, repeat=repeat)
+        same = np.array_equal(cti["freq"], freq) and all(
+            np.array_equal(new, old) for new, old in zip(cti["data"], blocks)
+        )
+        failed += not same
+        print(f"cti  {t_old * 1000:>7.1f} ms -> {t_new * 1000:>6.1f} ms  same: {same}")
+        t_old, columns = time_call(read_prn_lines, prn_path, repeat=repeat)
+        t_new, (names, values) = time_call(read_prn, prn_path, repeat=repeat)
+        same = names == [c[0] for c in columns] and np.array_equal(
+            values, np.array([c[1:] for c in columns]).T
+        )
+        failed += not same
+        print(f"prn  {t_old * 1000:>7.1f} ms -> {t_new * 1000:>6.1f} ms  same: {same}")
+        for case, (text, expected) in CTI_CASES.items():
+            path = os.path.join(folder, "case.cti")
+            with open(path, "w", newline="") as f:
+                f.write(text)
+            try:
+                cti = read_cti(path)
+                result = (len(cti["data"]), len(cti["freq"]))
+            except ValueError:
+                result = None
+            failed += result != expected
+            print(f"{case:<14} {'ok' if result == expected else f'got {result}'}")
+    if failed:
+        sys.exit(1)
+
+
+cli.add_command(waxs_parse)
+cli.add_command(baseline)
+cli.add_command(air)
+cli.add_command(crystallinity)
+cli.add_command(groups)
+cli.add_command(dsc)
+cli.add_command(cti)
+cli.add_command(cti_parse)
+
+if __name__ == "__main__":
+    cli()
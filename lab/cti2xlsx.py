@@ -1,14 +1,268 @@
+import glob
 import os
-import tkinter as tk
-from tkinter.filedialog import askopenfilenames
 
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill
-from openpyxl.styles.borders import BORDER_THIN, Border, Side
-from openpyxl.utils import get_column_letter
+import click
+import numpy as np
+import pandas as pd
+import xlsxwriter
+from xlsxwriter.worksheet import Worksheet
 
+from ctiparse import read_cti, read_prn
+
+
+# Colours of the cells
+COL_YEL = "#FFE699"
+COL_GRN = "#C6E0B4"
+COL_BLU = "#BDD7EE"
+COL_RED = "#F8CBAD"
+COL_PIN = "#FF9999"
+COL_ALR = "#FFFF99"
+
+CTI_TITLES = {
+    2: "Odrazí",
+    3: "Na druhou",
+    5: "Projde",
+    6: "Na druhou",
+    7: "Absorbuje",
+    8: "Na druhou",
+    9: "Kontrola",
+    14: "SE Total",
+    15: "New Power",
+    17: "SE Total",
+}
+CTI_HEADERS = [
+    None,
+    "S11",
+    "R (%)",
+    "R2 (%)",
+    "S21",
+    "T (%)",
+    "TR (%)",
+    "A (%)",
+    "A2 (%)",
+    "R2 + T2 + A2",
+    "S12",
+    "S22",
+    "SER",
+    "SEA",
+    "SER + SEA",
+    "SER",
+    "SEA",
+    "SER + SEA",
+]
+# Measured values by their index in cti_columns, or the formula of the column
+CTI_COLUMNS = [
+    0,
+    1,
+    "=POWER(10,(B{r}/20))",
+    "=POWER(C{r},2)*(100)",
+    2,
+    "=POWER(10,(E{r}/20))",
+    "=POWER(F{r},2)*(100)",
+    "=SQRT(1-((POWER(C{r},2))+(POWER(F{r},2))))",
+    "=POWER(H{r},2)*(100)",
+    "=(D{r}+G{r}+I{r})",
+    3,
+    4,
+    "=ABS(10*LOG(1/ABS(1-B{r}^2)))",
+    "=ABS(10*LOG(ABS((1-B{r}^2)/K{r}^2)))",
+    "=ABS(M{r}+N{r})",
+    "=10*LOG(1/(1-10^(B{r}/10)))",
+    "=10*LOG((1-10^(B{r}/10))/10^(E{r}/10))",
+    "=ABS(P{r}+Q{r})",
+]
+# Names of the columns in the tables saved next to the workbooks
+TABLE_COLUMNS = [
+    "frequency",
+    "s11",
+    "r",
+    "r2",
+    "s21",
+    "t",
+    "t2",
+    "a",
+    "a2",
+    "r2_t2_a2",
+    "s12",
+    "s22",
+    "ser",
+    "sea",
+    "se_total",
+    "ser_power",
+    "sea_power",
+    "se_total_power",
+]
+TABLE_WRITERS = {
+    "csv": lambda table, path: table.to_csv(path, index=False),
+    "parquet": lambda table, path: table.to_parquet(path, index=False),
+}
+CTI_FILLS = [
+    None,
+    None,
+    COL_GRN,
+    COL_GRN,
+    None,
+    COL_BLU,
+    COL_BLU,
+    COL_RED,
+    COL_RED,
+    COL_RED,
+    None,
+    None,
+    None,
+    None,
+    None,
+    COL_PIN,
+    COL_PIN,
+    COL_PIN,
+]
+
+
+def cti_columns(path: str):
+    # Frequencies and the first value of the S11, S21, S12 and S22 blocks
+    cti = read_cti(path)
+    if len(cti["data"]) < 4:
+        raise ValueError(f"Expected 4 data blocks, found {len(cti['data'])} in {path}")
+    return [cti["freq"]] + [values[:, 0] for values in cti["data"][:4]]
+
+
+class FormulaSheet(Worksheet):
+    # The formulas only use functions every Excel version knows, so the search
+    # for newer functions to prefix, run on each formula, is skipped. Neither
+    # write_formula nor the use_future_functions option avoids that search
+    def _prepare_formula(self, formula, expand_future_functions=False):
+        return formula.lstrip("=")
+
+
+# _prepare_formula is private, so the override is only used with the xlsxwriter
+# version it was checked against, other versions write with the stock sheet
+SHEET_CLASS = FormulaSheet if xlsxwriter.__version__ == "3.2.9" else Worksheet
+
+
+def shielding_table(cti: list):
+    # Every column of the cti sheet computed like the Excel formulas do,
+    # what Excel shows as an error is left as NaN or inf
+    freq, s11, s21, s12, s22 = (np.asarray(column, dtype=float) for column in cti)
+    with np.errstate(all="ignore"):
+        r = np.power(10, s11 / 20)
+        t = np.power(10, s21 / 20)
+        a = np.sqrt(1 - (r**2 + t**2))
+        ser = np.abs(10 * np.log10(1 / np.abs(1 - s11**2)))
+        sea = np.abs(10 * np.log10(np.abs((1 - s11**2) / s12**2)))
+        ser_power = 10 * np.log10(1 / (1 - np.power(10, s11 / 10)))
+        sea_power = 10 * np.log10(
+            (1 - np.power(10, s11 / 10)) / np.power(10, s21 / 10)
+        )
+    columns = [
+        freq,
+        s11,
+        r,
+        r**2 * 100,
+        s21,
+        t,
+        t**2 * 100,
+        a,
+        a**2 * 100,
+        (r**2 + t**2 + a**2) * 100,
+        s12,
+        s22,
+        ser,
+        sea,
+        np.abs(ser + sea),
+        ser_power,
+        sea_power,
+        np.abs(ser_power + sea_power),
+    ]
+    return pd.DataFrame(dict(zip(TABLE_COLUMNS, columns)))
+
+
+def write_xlsx(
+    path: str,
+    name: str,
+    cti: list,
+    prn: tuple = None,
+    table=None,
+    keep_formulas=False,
+):
+    # Rows are streamed to the file in order, every cell style is made once.
+    # With a shielding_table its values are written instead of the formulas,
+    # keep_formulas adds the formulas on a second sheet
+    workbook = xlsxwriter.Workbook(
+        path, {"constant_memory": True, "nan_inf_to_errors": True}
+    )
+    formats = {}
+
+    def style(color=None, border=False):
+        if (color, border) not in formats:
+            properties = {"bottom": 1} if border else {}
+            if color:
+                properties.update(pattern=1, bg_color=color)
+            formats[color, border] = workbook.add_format(properties)
+        return formats[color, border]
+
+    def write_cti(title: str, values=None):
+        ws_cti = workbook.add_worksheet(title, worksheet_class=SHEET_CLASS)
+        ws_cti.set_column(0, len(CTI_COLUMNS) - 1, 13)
+        ws_cti.write(0, 0, name, style(COL_YEL))
+        for col in range(1, len(CTI_COLUMNS)):
+            ws_cti.write(0, col, CTI_TITLES.get(col), style(CTI_FILLS[col]))
+        for col, header in enumerate(CTI_HEADERS):
+            ws_cti.write(1, col, header, style(CTI_FILLS[col], border=True))
+
+        # Yellow the line when frequency ghz changes
+        ghz = np.floor_divide(cti[0], 10**9)
+        alert = np.concatenate(([False], ghz[1:] != ghz[:-1]))
+        fills = [style(color) for color in CTI_FILLS]
+        alert_fills = [style(COL_ALR)] * len(CTI_COLUMNS)
+        for i in range(len(cti[0])):
+            row_fills = alert_fills if alert[i] else fills
+            if values is not None:
+                for col, value in enumerate(values[i]):
+                    ws_cti.write_number(i + 2, col, value, row_fills[col])
+                continue
+            for col, value in enumerate(CTI_COLUMNS):
+                if isinstance(value, str):
+                    formula = value.format(r=i + 3)
+                    ws_cti.write_formula(i + 2, col, formula, row_fills[col])
+                else:
+                    ws_cti.write_number(i + 2, col, cti[value][i], row_fills[col])
+
+    if table is None:
+        write_cti("cti data")
+    else:
+        write_cti("cti data", table[TABLE_COLUMNS].to_numpy().tolist())
+        if keep_formulas:
+            write_cti("cti formulas")
+
+    if prn is not None:
+        names, prn_values = prn
+        ws_prn = workbook.add_worksheet("prn data")
+        ws_prn.set_column(0, 5, 13)
+        ws_prn.write(0, 0, name, style(COL_YEL))
+        for col in range(max(6, len(names) + 1)):
+            header = names[col - 1] if 0 < col <= len(names) else None
+            ws_prn.write(1, col, header, style(border=True) if col < 6 else None)
+        # The first collumn holds the point numbers
+        for row, values in enumerate(prn_values.tolist(), 2):
+            ws_prn.write_number(row, 1, int(values[0]))
+            for col, value in enumerate(values[1:], 2):
+                ws_prn.write_number(row, col, value)
+    workbook.close()
+
+
+def find_files(patterns: tuple):
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.cti")
+        files += sorted(glob.glob(pattern, recursive=True))
+    return list(dict.fromkeys(files))
+
+
+def ask_files():
+    import tkinter as tk
+    from tkinter.filedialog import askopenfilenames
 
-def main():
     # Ask for the working files, prn files are optional
     root = tk.Tk()
     root.withdraw()
@@ -16,12 +270,37 @@ def main():
     ctis = askopenfilenames(
         title="Select the cti file(s)", filetypes=[("cti files", ".cti")]
     )
+    prns = []
     do_prn = input("Would you like to analyze prn files as well? (Y/N)\n")
     if do_prn == "Y" or do_prn == "y":
         print("Select the prn file(s)")
         prns = askopenfilenames(
             title="Select the prn file(s)", filetypes=[("prn files", ".prn")]
         )
+    return ctis, prns
+
+
+@click.command()
+@click.argument("paths", nargs=-1)
+@click.option("--values", is_flag=True, help="Write computed values, not formulas.")
+@click.option(
+    "--keep-formulas", is_flag=True, help="With --values, add a sheet of formulas."
+)
+@click.option(
+    "--table",
+    type=click.Choice(list(TABLE_WRITERS)),
+    help="Also save the computed columns as a table.",
+)
+def main(paths, values, keep_formulas, table):
+    """Convert cti files (or folders and globs of them) to xlsx, along with
+    the matching -prn.prn files. Without PATHS the files are picked in a dialog."""
+    if paths:
+        ctis = find_files(paths)
+        prns = [f"{cti[:-4]}-prn.prn" for cti in ctis]
+        prns = [prn for prn in prns if os.path.exists(prn)]
+    else:
+        ctis, prns = ask_files()
+    do_prn = "Y" if prns else "N"
 
     gave_prn_error = 0
     for x, cti_file in enumerate(ctis, 1):
@@ -53,203 +332,25 @@ def main():
                     )
                     gave_prn_error = 1
 
-        # Read the cti file as lines
-        with open(cti_file) as f:
-            lines = f.read().splitlines()
-        # Find the indices of beggining and ending lines for each data collumn
-        fre_beg = lines.index("VAR_LIST_BEGIN") + 1
-        fre_end = lines.index("VAR_LIST_END")
-        s11_beg = lines.index("BEGIN", fre_end) + 1
-        s11_end = lines.index("END", s11_beg)
-        s21_beg = lines.index("BEGIN", s11_end) + 1
-        s21_end = lines.index("END", s21_beg)
-        s12_beg = lines.index("BEGIN", s21_end) + 1
-        s12_end = lines.index("END", s12_beg)
-        s22_beg = lines.index("BEGIN", s12_end) + 1
-        s22_end = lines.index("END", s22_beg)
-        # Put the found data into lists
-        # The sXX data have two values on each line, we only care for the first one
-        fre_list = lines[fre_beg:fre_end]
-        s11_list = [i.split(",")[0] for i in lines[s11_beg:s11_end]]
-        s21_list = [i.split(",")[0] for i in lines[s21_beg:s21_end]]
-        s12_list = [i.split(",")[0] for i in lines[s12_beg:s12_end]]
-        s22_list = [i.split(",")[0] for i in lines[s22_beg:s22_end]]
-
-        # Read the prn file as lines, if it doesn't exist, ignore this whole step
-        if found_match == 1:
-            with open(prn_file) as f:
-                lines = f.read().splitlines()
-            # There might be a different number (n) of collumns with info
-            # So make a list of lists (with data for each col) of the length n
-            num_of_vals = len(lines[3].split())
-            prn_data = []
-            for n in range(0, num_of_vals):
-                temp_list = [i.split()[n] for i in lines[3:]]
-                prn_data.append(temp_list)
-            for i in range(0, len(prn_data)):
-                for j in range(1, len(prn_data[0])):
-                    prn_data[i][j] = float(prn_data[i][j])
-            for i in range(1, len(prn_data[0])):
-                prn_data[0][i] = int(prn_data[0][i])
-
-        # Make an excel file and write the static info
-        wb = Workbook()
-        ws_cti = wb.active
-        ws_cti.title = "cti data"
-        ws_cti["A1"].value = cti_name
-        ws_cti["C1"].value = "Odrazí"
-        ws_cti["D1"].value = "Na druhou"
-        ws_cti["F1"].value = "Projde"
-        ws_cti["G1"].value = "Na druhou"
-        ws_cti["H1"].value = "Absorbuje"
-        ws_cti["I1"].value = "Na druhou"
-        ws_cti["J1"].value = "Kontrola"
-        ws_cti["O1"].value = "SE Total"
-        ws_cti["P1"].value = "New Power"
-        ws_cti["R1"].value = "SE Total"
-        ws_cti["B2"].value = "S11"
-        ws_cti["C2"].value = "R (%)"
-        ws_cti["D2"].value = "R2 (%)"
-        ws_cti["E2"].value = "S21"
-        ws_cti["F2"].value = "T (%)"
-        ws_cti["G2"].value = "TR (%)"
-        ws_cti["H2"].value = "A (%)"
-        ws_cti["I2"].value = "A2 (%)"
-        ws_cti["J2"].value = "R2 + T2 + A2"
-        ws_cti["K2"].value = "S12"
-        ws_cti["L2"].value = "S22"
-        ws_cti["M2"].value = "SER"
-        ws_cti["N2"].value = "SEA"
-        ws_cti["O2"].value = "SER + SEA"
-        ws_cti["P2"].value = "SER"
-        ws_cti["Q2"].value = "SEA"
-        ws_cti["R2"].value = "SER + SEA"
-
-        # Make the cells wider
-        for i in range(1, 19):
-            ws_cti.column_dimensions[get_column_letter(i)].width = 13
-            ws_cti[get_column_letter(i) + "2"].border = Border(
-                bottom=Side(border_style=BORDER_THIN, color="00000000")
-            )
-
-        # Colour the cells
-        col_yel = "FFE699"
-        col_grn = "C6E0B4"
-        col_blu = "BDD7EE"
-        col_red = "F8CBAD"
-        col_pin = "FF9999"
-        col_alr = "FFFF99"
-
-        ws_cti["A1"].fill = PatternFill(fgColor=col_yel, fill_type="solid")
-        ws_cti["C1"].fill = PatternFill(fgColor=col_grn, fill_type="solid")
-        ws_cti["D1"].fill = PatternFill(fgColor=col_grn, fill_type="solid")
-        ws_cti["C2"].fill = PatternFill(fgColor=col_grn, fill_type="solid")
-        ws_cti["D2"].fill = PatternFill(fgColor=col_grn, fill_type="solid")
-        ws_cti["F1"].fill = PatternFill(fgColor=col_blu, fill_type="solid")
-        ws_cti["G1"].fill = PatternFill(fgColor=col_blu, fill_type="solid")
-        ws_cti["F2"].fill = PatternFill(fgColor=col_blu, fill_type="solid")
-        ws_cti["G2"].fill = PatternFill(fgColor=col_blu, fill_type="solid")
-        ws_cti["H1"].fill = PatternFill(fgColor=col_red, fill_type="solid")
-        ws_cti["I1"].fill = PatternFill(fgColor=col_red, fill_type="solid")
-        ws_cti["J1"].fill = PatternFill(fgColor=col_red, fill_type="solid")
-        ws_cti["H2"].fill = PatternFill(fgColor=col_red, fill_type="solid")
-        ws_cti["I2"].fill = PatternFill(fgColor=col_red, fill_type="solid")
-        ws_cti["J2"].fill = PatternFill(fgColor=col_red, fill_type="solid")
-        ws_cti["P1"].fill = PatternFill(fgColor=col_pin, fill_type="solid")
-        ws_cti["Q1"].fill = PatternFill(fgColor=col_pin, fill_type="solid")
-        ws_cti["R1"].fill = PatternFill(fgColor=col_pin, fill_type="solid")
-        ws_cti["P2"].fill = PatternFill(fgColor=col_pin, fill_type="solid")
-        ws_cti["Q2"].fill = PatternFill(fgColor=col_pin, fill_type="solid")
-        ws_cti["R2"].fill = PatternFill(fgColor=col_pin, fill_type="solid")
-
-        # Write cti values
-        last_ghz = str(int(fre_list[0]))[:-9]
-        for i in range(0, len(fre_list)):
-            ws_cti["A" + str(i + 3)].value = float(fre_list[i])
-            ws_cti["B" + str(i + 3)].value = float(s11_list[i])
-            ws_cti["C" + str(i + 3)].value = f"=POWER(10,(B{i + 3}/20))"
-            ws_cti["D" + str(i + 3)].value = f"=POWER(C{i + 3},2)*(100)"
-            ws_cti["E" + str(i + 3)].value = float(s21_list[i])
-            ws_cti["F" + str(i + 3)].value = f"=POWER(10,(E{i + 3}/20))"
-            ws_cti["G" + str(i + 3)].value = f"=POWER(F{i + 3},2)*(100)"
-            ws_cti[
-                "H" + str(i + 3)
-            ].value = f"=SQRT(1-((POWER(C{i + 3},2))+(POWER(F{i + 3},2))))"
-            ws_cti["I" + str(i + 3)].value = f"=POWER(H{i + 3},2)*(100)"
-            ws_cti["J" + str(i + 3)].value = f"=(D{i + 3}+G{i + 3}+I{i + 3})"
-            ws_cti["K" + str(i + 3)].value = float(s12_list[i])
-            ws_cti["L" + str(i + 3)].value = float(s22_list[i])
-            ws_cti["M" + str(i + 3)].value = f"=ABS(10*LOG(1/ABS(1-B{i + 3}^2)))"
-            ws_cti[
-                "N" + str(i + 3)
-            ].value = f"=ABS(10*LOG(ABS((1-B{i + 3}^2)/K{i + 3}^2)))"
-            ws_cti["O" + str(i + 3)].value = f"=ABS(M{i + 3}+N{i + 3})"
-            ws_cti["P" + str(i + 3)].value = f"=10*LOG(1/(1-10^(B{i + 3}/10)))"
-            ws_cti[
-                "Q" + str(i + 3)
-            ].value = f"=10*LOG((1-10^(B{i + 3}/10))/10^(E{i + 3}/10))"
-            ws_cti["R" + str(i + 3)].value = f"=ABS(P{i + 3}+Q{i + 3})"
-            # Colour the cells for each collumn that needs it
-            ws_cti["C" + str(i + 3)].fill = PatternFill(
-                fgColor=col_grn, fill_type="solid"
-            )
-            ws_cti["D" + str(i + 3)].fill = PatternFill(
-                fgColor=col_grn, fill_type="solid"
-            )
-            ws_cti["F" + str(i + 3)].fill = PatternFill(
-                fgColor=col_blu, fill_type="solid"
-            )
-            ws_cti["G" + str(i + 3)].fill = PatternFill(
-                fgColor=col_blu, fill_type="solid"
-            )
-            ws_cti["H" + str(i + 3)].fill = PatternFill(
-                fgColor=col_red, fill_type="solid"
-            )
-            ws_cti["I" + str(i + 3)].fill = PatternFill(
-                fgColor=col_red, fill_type="solid"
-            )
-            ws_cti["J" + str(i + 3)].fill = PatternFill(
-                fgColor=col_red, fill_type="solid"
-            )
-            ws_cti["P" + str(i + 3)].fill = PatternFill(
-                fgColor=col_pin, fill_type="solid"
-            )
-            ws_cti["q" + str(i + 3)].fill = PatternFill(
-                fgColor=col_pin, fill_type="solid"
-            )
-            ws_cti["r" + str(i + 3)].fill = PatternFill(
-                fgColor=col_pin, fill_type="solid"
-            )
-            # Yellow the line when frequency ghz changes
-            ghz = str(int(fre_list[i]))[:-9]
-            if ghz != last_ghz:
-                for j in range(1, 19):
-                    ws_cti[get_column_letter(j) + str(i + 3)].fill = PatternFill(
-                        fgColor=col_alr, fill_type="solid"
-                    )
-            last_ghz = ghz
-
-        # Open the prn workseet if prn file was foudn and write the prn values
-        # Also do all the cell eiditng like in cti worksheet
-        if found_match == 1:
-            ws_prn = wb.create_sheet("prn data")
-            ws_prn["A1"].value = cti_name
-            ws_prn["A1"].fill = PatternFill(fgColor=col_yel, fill_type="solid")
-            for i in range(1, 7):
-                ws_prn.column_dimensions[get_column_letter(i)].width = 13
-                ws_prn[get_column_letter(i) + "2"].border = Border(
-                    bottom=Side(border_style=BORDER_THIN, color="00000000")
-                )
-            for i in range(0, len(prn_data)):
-                for j in range(0, len(prn_data[0])):
-                    ws_prn[get_column_letter(i + 2) + str(j + 2)].value = prn_data[i][j]
-
-        # Save and close the excel file
-        wb.save(cti_file[:-4] + ".xlsx")
-        wb.close()
+        # Write the cti values and the prn values if a prn file was found
+        prn_data = read_prn(prn_file) if found_match == 1 else None
+        cti_data = cti_columns(cti_file)
+        computed = shielding_table(cti_data) if values or table else None
+        write_xlsx(
+            cti_file[:-4] + ".xlsx",
+            cti_name,
+            cti_data,
+            prn_data,
+            computed if values else None,
+            keep_formulas,
+        )
+        if table:
+            TABLE_WRITERS[table](computed, f"{cti_file[:-4]}.{table}")
 
-    print("\nAll done\nPress any key to exit")
-    input()
+    print("\nAll done")
+    if not paths:
+        print("Press any key to exit")
+        input()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+import re
+
+import numpy as np
+
+DATA = re.compile(r"^DATA[ \t]+(\S+)(?:[ \t]+(\S+))?", re.M)
+SEG = re.compile(r"^SEG[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\d+)", re.M)
+
+
+def _blocks(text: str):
+    # Kind (VAR_LIST_, SEG_LIST_ or an empty string for data) and text of every
+    # BEGIN ... END block, found with plain string searches in a single pass
+    pos = 0
+    while True:
+        start = text.find("BEGIN", pos)
+        if start == -1:
+            return
+        kind = text[text.rfind("\n", 0, start) + 1 : start]
+        content = text.find("\n", start) + 1
+        end = text.find(f"\n{kind}END", content - 1)
+        if content == 0 or end == -1:
+            raise ValueError(f"{kind}BEGIN without {kind}END")
+        yield kind, text[content:end]
+        pos = end + len(kind) + 4
+
+
+def _block(text: str):
+    # All values of a block at once, one row per line and one column per value
+    text = text.strip()
+    if not text:
+        return np.empty((0, 1))
+    lines = text.split("\n")
+    if len({line.count(",") for line in lines}) > 1:
+        raise ValueError("Lines of a data block have different numbers of values")
+    values = np.fromstring(text.replace("\n", ","), sep=",")
+    return values.reshape(len(lines), -1)
+
+
+def to_complex(values, fmt: str = "RI"):
+    # Complex numbers from the two columns of a data block in its CITI format,
+    # real and imaginary parts, magnitude and degrees or dB and degrees
+    first, second = values[:, 0], values[:, 1]
+    if fmt == "RI":
+        return first + 1j * second
+    if fmt == "MA":
+        return first * np.exp(1j * np.radians(second))
+    if fmt == "DB":
+        return 10 ** (first / 20) * np.exp(1j * np.radians(second))
+    raise ValueError(f"Unknown CITI data format {fmt}")
+
+
+def read_cti(path: str):
+    # Every DATA block between BEGIN and END, in the order of the file, as two
+    # columns in the format named on its DATA line (see to_complex), a second
+    # column of zeros when the lines hold one value only
+    with open(path) as f:
+        text = f.read()
+    header = text[: text.find("BEGIN")]
+    names = [m[1] for m in DATA.finditer(header)]
+    formats = [m[2] or "RI" for m in DATA.finditer(header)]
+    freq = None
+    data = []
+    try:
+        blocks = list(_blocks(text))
+    except ValueError as e:
+        raise ValueError(f"{e} in {path}") from None
+    for kind, block in blocks:
+        if kind == "SEG_LIST_":
+            seg = SEG.search(block)
+            freq = np.linspace(float(seg[1]), float(seg[2]), int(seg[3]))
+            continue
+        try:
+            values = _block(block)
+        except ValueError as e:
+            raise ValueError(f"{e} in {path}") from None
+        if kind == "VAR_LIST_":
+            freq = values[:, 0]
+        elif values.shape[1] > 1:
+            data.append(values[:, :2])
+        else:
+            data.append(np.column_stack((values[:, 0], np.zeros(len(values)))))
+    if freq is None:
+        raise ValueError(f"No frequencies found in {path}")
+    for values in data:
+        if len(values) != len(freq):
+            raise ValueError(f"Data blocks and frequencies differ in length in {path}")
+    return {"freq": freq, "names": names, "formats": formats, "data": data}
+
+
+def read_prn(path: str):
+    # Three lines of info, a line of column names and then the values,
+    # the first column holds the point numbers
+    with open(path) as f:
+        lines = f.read().splitlines()
+    names = lines[3].split()
+    values = np.loadtxt(lines[4:], ndmin=2, dtype=np.float64)
+    if values.shape[1] != len(names):
+        raise ValueError(f"{len(names)} column names but {values.shape[1]} columns")
+    return names, values
@@ -1,33 +1,158 @@
+import glob
+import hashlib
+import itertools
+import json
 import os
-import tkinter as tk
-from tkinter.filedialog import askopenfilenames
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from time import perf_counter
 
+import click
+import matplotlib
 import numpy as np
+import pandas as pd
 import seaborn as sns
+import yaml
 from matplotlib import pyplot as plt
-from scipy.signal import find_peaks
+from scipy.signal import find_peaks, peak_widths
 
 DEBUG = 0
+# Only this temperature range of each curve is evaluated, bounds excluded
+T_MIN = 50
+T_MAX = 275
+# Heat flow added to the second heating and the cooling to space out the plot
+OFFSET = 8
+CURVE_START = re.compile("Curve Values:")
+CURVE_END = re.compile("Results:")
+# Share of the peak prominence where the integration limits of a peak are placed
+# first, before they are moved out to where the peak meets its baseline
+PEAK_LIMIT = 0.98
+# Melting enthalpy of a fully crystalline polymer in J/g, for the crystallinity
+DH100 = 207.0
+METRICS_FILE = "dsc_metrics.csv"
+# Content hashes and metrics of the processed files, next to the metrics file
+CACHE_FILE = "dsc_eval_cache.json"
+# Raise it when the metrics are computed differently, so cached ones are redone
+METRICS_VERSION = 2
+# Bounds given to scipy find_peaks, replaced by PEAK_CONFIG when it exists
+PEAK_PARAMS = {"width": [0.1, 400], "height": [0.5, 100], "prominence": [0.1, 100]}
+PEAK_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dsc_peaks.yaml")
+# Lower bounds tried by --tune, the upper bounds stay as in PEAK_PARAMS
+TUNE_GRID = {
+    "width": [0.1, 1, 5, 20],
+    "height": [0.1, 0.25, 0.5, 1, 2],
+    "prominence": [0.05, 0.1, 0.25, 0.5, 1],
+}
+# Cost of a missed or extra peak when tuning, in °C of peak position error
+MISS_COST = 10
+
+if not DEBUG:
+    matplotlib.use("Agg")
+
+
+def outer_limit(signal, start, stop: int):
+    # Moves a limit from start away from its peak to where the signal is back
+    # at the flattened baseline, without passing stop
+    index = int(start)
+    step = 1 if stop > index else -1
+    while index != stop and signal[index] > 0:
+        index += step
+    return index
 
 
 class Curve:
-    def __init__(self, x, y, sign=-1):
+    def __init__(self, x, y, sign=-1, t=None):
         self.x = x
         self.y = y
+        self.t = t
+        self.y_flat = None
         self.peaks = None
         self.peaks_info = None
+        self.metrics = None
         self.sign = sign
 
-    def find_peaks(self):
-        y_line = np.linspace(self.y[0], self.y[-1], num=len(self.y))
-        y_flat = self.y - y_line
-        self.peaks, self.peaks_info = find_peaks(
-            y_flat * self.sign,
-            width=(0.1, 400),
-            height=(0.5, 100),
-            prominence=(0.1, 100),
+    def flatten(self):
+        if self.y_flat is None:
+            y_line = np.linspace(self.y[0], self.y[-1], num=len(self.y))
+            self.y_flat = self.y - y_line
+        return self.y_flat
+
+    def find_peaks(self, params: dict = None):
+        bounds = {key: tuple(value) for key, value in (params or PEAK_PARAMS).items()}
+        self.peaks, self.peaks_info = find_peaks(self.flatten() * self.sign, **bounds)
+
+    def get_metrics(self):
+        # Each peak is integrated above a straight local baseline between the
+        # points where it rises from the curve, onset and endset are where the
+        # steepest tangents on both sides cross that baseline
+        signal = self.flatten() * self.sign
+        half = peak_widths(signal, self.peaks, rel_height=0.5)
+        limits = peak_widths(signal, self.peaks, rel_height=PEAK_LIMIT)
+        index = np.arange(len(self.x))
+        # The limits go out at most one half width further and never past the
+        # lowest point between two neighbouring peaks
+        bounds = np.concatenate(([0], self.peaks, [len(signal) - 1]))
+        valleys = [a + np.argmin(signal[a : b + 1]) for a, b in zip(bounds, bounds[1:])]
+        left = np.array(
+            [
+                outer_limit(signal, l, max(valley, int(l - w)))
+                for l, valley, w in zip(np.floor(limits[2]), valleys, half[0])
+            ],
+            dtype=int,
+        )
+        right = np.array(
+            [
+                outer_limit(signal, r, min(valley, int(r + w)))
+                for r, valley, w in zip(np.ceil(limits[3]), valleys[1:], half[0])
+            ],
+            dtype=int,
+        )
+
+        x_left, x_right = self.x[left], self.x[right]
+        y_left, y_right = self.y[left], self.y[right]
+        slope_base = (y_right - y_left) / (x_right - x_left)
+        # Steepest in the order of measurement, a cooling runs down in temperature
+        rise = np.gradient(signal)
+        slope = np.gradient(self.y, self.x)
+        steep_left = np.array(
+            [l + np.argmax(rise[l : p + 1]) for l, p in zip(left, self.peaks)],
+            dtype=int,
+        )
+        steep_right = np.array(
+            [p + np.argmin(rise[p : r + 1]) for p, r in zip(self.peaks, right)],
+            dtype=int,
         )
 
+        def crossing(steep):
+            slope_tangent = slope[steep]
+            return (
+                self.y[steep]
+                - y_left
+                - slope_tangent * self.x[steep]
+                + slope_base * x_left
+            ) / (slope_base - slope_tangent)
+
+        # Area under the curve from cumulative trapezoids, minus the baseline
+        if self.t is None:
+            enthalpy = np.full(len(self.peaks), np.nan)
+        else:
+            steps = np.diff(self.t) * (self.y[1:] + self.y[:-1]) / 2
+            area = np.concatenate(([0], np.cumsum(steps)))
+            base = (self.t[right] - self.t[left]) * (y_left + y_right) / 2
+            enthalpy = (area[right] - area[left] - base) * self.sign
+        self.metrics = {
+            "onset": crossing(steep_left),
+            "peak": self.x[self.peaks],
+            "endset": crossing(steep_right),
+            "half_width": np.abs(
+                np.interp(half[3], index, self.x) - np.interp(half[2], index, self.x)
+            ),
+            "enthalpy": enthalpy,
+        }
+        return self.metrics
+
     def plot(self, name, color):
         plt.plot(self.x, self.y, color, label=name)
         plt.plot(self.x[self.peaks], self.y[self.peaks], f"x{color}")
@@ -83,12 +208,33 @@ class Sample:
         self.curve_heat_2 = heat_2
         self.curve_cool = cool
 
-    def find_curve_peaks(self):
-        self.curve_heat_1.find_peaks()
-        self.curve_heat_2.find_peaks()
-        self.curve_cool.find_peaks()
+    def find_curve_peaks(self, params: dict = None):
+        self.curve_heat_1.find_peaks(params)
+        self.curve_heat_2.find_peaks(params)
+        self.curve_cool.find_peaks(params)
 
-    def plot_curves(self):
+    def curves(self):
+        return {
+            "First heating": self.curve_heat_1,
+            "Cooling": self.curve_cool,
+            "Second heating": self.curve_heat_2,
+        }
+
+    def get_metrics(self, dh100: float = DH100):
+        # One row per peak, the crystallinity only for the melting peaks
+        tables = []
+        for name, curve in self.curves().items():
+            table = pd.DataFrame(curve.get_metrics())
+            table.insert(0, "curve", name)
+            table.insert(0, "sample", self.name)
+            table["crystallinity"] = np.nan
+            if curve.sign == -1:
+                table["crystallinity"] = table["enthalpy"] / dh100 * 100
+            tables.append(table)
+        self.metrics = pd.concat(tables, ignore_index=True)
+        return self.metrics
+
+    def plot_curves(self, path: str = None):
         sns.set_theme()
         sns.set_style("whitegrid")
         self.curve_cool.plot("Cooling", "r")
@@ -97,7 +243,7 @@ class Sample:
         plt.title(self.name, fontweight="bold")
         plt.xlabel("Temperature [°C]")
         plt.ylabel("Heat flow [W/g]")
-        plt.xlim(50, 275)
+        plt.xlim(T_MIN, T_MAX)
         plt.yticks(color="None", fontsize=0)
         plt.legend(loc="upper left")
         if DEBUG:
@@ -109,69 +255,331 @@ class Sample:
             plt.show()
         else:
             plt.gcf().set_size_inches(16, 9)
-            plt.savefig(f"{self.path[:-4]}.png", dpi=300)
+            plt.savefig(path or f"{self.path[:-4]}.png", dpi=300)
             plt.close()
 
 
-def main():
+def _line_start(text: str, pos: int, lines: int = 0):
+    # Start of the line holding pos, moved by a number of lines up (<0) or down
+    start = text.rfind("\n", 0, pos) + 1
+    for _ in range(lines):
+        start = text.index("\n", start) + 1
+    for _ in range(-lines):
+        start = text.rfind("\n", 0, start - 1) + 1
+    return start
+
+
+def read_curves(path: str, t_min: float = T_MIN, t_max: float = T_MAX):
+    # Every block of data between "Curve Values:" and "Results:" parsed at once,
+    # as time, temperature and heat flow arrays within the temperature window
+    with open(path) as f:
+        text = f.read().replace(",", ".")
+    starts = [_line_start(text, m.start(), 3) for m in CURVE_START.finditer(text)]
+    ends = [_line_start(text, m.start(), -2) for m in CURVE_END.finditer(text)]
+    curves = []
+    for start, end in zip(starts, ends):
+        data = np.loadtxt(
+            text[start:end].splitlines(), usecols=(1, 2, 3), ndmin=2, dtype=np.float64
+        )
+        inside = (data[:, 1] > t_min) & (data[:, 1] < t_max)
+        curves.append(tuple(data[inside].T))
+    return curves
+
+
+def read_sample(path: str):
+    curves = read_curves(path)
+    if len(curves) < 3:
+        raise ValueError(f"Expected 3 curves, found {len(curves)} in {path}")
+    heat1, cool, heat2 = curves[:3]
+    return Sample(
+        os.path.split(path)[1][:-4],
+        path,
+        Curve(heat1[1], heat1[2], t=heat1[0]),
+        Curve(heat2[1], heat2[2] + OFFSET, t=heat2[0]),
+        Curve(cool[1], cool[2] + OFFSET, 1, t=cool[0]),
+    )
+
+
+def write_metrics(table, path: str):
+    if path.lower().endswith(".parquet"):
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
+
+
+def file_hash(path: str):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def plot_path(path: str, folder: str = None):
+    name = f"{os.path.splitext(os.path.split(path)[1])[0]}.png"
+    return os.path.join(folder or os.path.split(path)[0], name)
+
+
+def process_file(
+    path: str,
+    entry: dict = None,
+    folder: str = None,
+    force=False,
+    dh100=DH100,
+    params: dict = None,
+):
+    # Returns the cache entry of the file and an error, or "skipped" when the
+    # graph is newer than the file or the content didn't change since, both
+    # with the same find_peaks bounds, dh100 and METRICS_VERSION
+    png = plot_path(path, folder)
+    digest = None
+    params = params or PEAK_PARAMS
+    current = (
+        entry is not None
+        and entry.get("params") == params
+        and entry.get("dh100") == dh100
+        and entry.get("version") == METRICS_VERSION
+    )
+    if not force and current and os.path.exists(png):
+        if os.path.getmtime(png) >= os.path.getmtime(path):
+            return path, entry, "skipped"
+        digest = file_hash(path)
+        if digest == entry["hash"]:
+            return path, entry, "skipped"
+    try:
+        sample = read_sample(path)
+        sample.find_curve_peaks(params)
+        sample.get_metrics(dh100)
+        sample.plot_curves(png)
+    except (ValueError, IndexError) as e:
+        return path, None, str(e)
+    entry = {
+        "hash": digest or file_hash(path),
+        "params": params,
+        "dh100": dh100,
+        "version": METRICS_VERSION,
+        "metrics": sample.metrics.to_dict("records"),
+    }
+    return path, entry, None
+
+
+def load_cache(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache: dict, path: str):
+    temp = f"{path}.tmp"
+    with open(temp, "w") as f:
+        json.dump(cache, f)
+    os.replace(temp, path)
+
+
+def load_peak_params(path: str = PEAK_CONFIG):
+    if not os.path.exists(path):
+        return PEAK_PARAMS
+    with open(path) as f:
+        params = yaml.safe_load(f)["find_peaks"]
+    for key, (low, high) in params.items():
+        if not low < high:
+            raise ValueError(f"find_peaks {key} bounds are not ascending")
+    return params
+
+
+# Flattened curves and their expected peaks, set once in every tuning worker
+_tune_curves = []
+
+
+def _set_tune_curves(curves: list):
+    global _tune_curves
+    _tune_curves = curves
+
+
+def score_params(params: dict):
+    # Distance of every expected peak to the nearest one found, capped at
+    # MISS_COST, plus MISS_COST for every peak found beyond the expected ones
+    bounds = {key: tuple(value) for key, value in params.items()}
+    cost = 0.0
+    for signal, x, expected in _tune_curves:
+        found = x[find_peaks(signal, **bounds)[0]]
+        if len(expected):
+            if len(found):
+                distance = np.abs(expected[:, None] - found[None, :]).min(axis=1)
+                cost += np.minimum(distance, MISS_COST).sum()
+            else:
+                cost += MISS_COST * len(expected)
+        cost += MISS_COST * max(0, len(found) - len(expected))
+    return cost
+
+
+def tune_peaks(files: list, labels: str, jobs: int, grid: dict = TUNE_GRID):
+    # Labels have a row for every expected peak with the sample, curve and peak
+    # temperature like the metrics table, curves left out expect no peaks
+    expected = pd.read_csv(labels).groupby(["sample", "curve"])["peak"]
+    expected = {key: np.sort(peaks.to_numpy()) for key, peaks in expected}
+    labelled = {sample for sample, _ in expected}
+    curves = []
+    for file in files:
+        sample = read_sample(file)
+        if sample.name not in labelled:
+            continue
+        for name, curve in sample.curves().items():
+            peaks = expected.get((sample.name, name), np.array([]))
+            curves.append((curve.flatten() * curve.sign, curve.x, peaks))
+    if not curves:
+        raise ValueError(f"None of the files are labelled in {labels}")
+
+    combos = [
+        {key: [low, PEAK_PARAMS[key][1]] for key, low in zip(grid, lows)}
+        for lows in itertools.product(*grid.values())
+    ]
+    print(f"Scoring {len(combos)} parameter sets on {len(curves)} curves")
+    if jobs > 1:
+        with ProcessPoolExecutor(
+            jobs, initializer=_set_tune_curves, initargs=(curves,)
+        ) as pool:
+            chunk = max(1, len(combos) // (jobs * 4))
+            costs = list(pool.map(score_params, combos, chunksize=chunk))
+    else:
+        _set_tune_curves(curves)
+        costs = list(map(score_params, combos))
+    order = np.argsort(costs, kind="stable")
+    return [(combos[num], costs[num]) for num in order]
+
+
+def save_peak_params(params: dict, path: str = PEAK_CONFIG):
+    with open(path, "w") as f:
+        f.write("# find_peaks bounds for dsc_eval.py, written by --tune\n")
+        yaml.safe_dump({"find_peaks": params}, f, default_flow_style=None)
+
+
+def find_files(patterns: tuple):
+    files = []
+    for pattern in patterns:
+        if os.path.isfile(pattern):
+            files.append(pattern)
+            continue
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.txt")
+        files += sorted(glob.glob(pattern, recursive=True))
+    return list(dict.fromkeys(files))
+
+
+def ask_files():
+    import tkinter as tk
+    from tkinter.filedialog import askopenfilenames
+
     root = tk.Tk()
     root.withdraw()
-    files = askopenfilenames(
+    return askopenfilenames(
         title="Select text files with DSC evaluations.",
         filetypes=[("Text files", ".txt")],
     )
-    samples = []
 
-    print(f"Reading {len(files)} files\n")
-    for file in files:
-        file_name = os.path.split(file)[1][:-4]
-        with open(file) as f:
-            lines = f.read().replace(",", ".").splitlines()
-        start_lines = []
-        end_lines = []
-        for index, line in enumerate(lines):
-            if "Curve Values:" in line:
-                start_lines.append(index + 3)
-            if "Results:" in line:
-                end_lines.append(index - 2)
-
-        heat1 = np.array(
-            [
-                [i.split()[2], i.split()[3]]
-                for i in lines[start_lines[0] : end_lines[0]]
-                if 50 < float(i.split()[2]) < 275
-            ]
-        ).astype(float)
-        heat2 = np.array(
-            [
-                [float(i.split()[2]), float(i.split()[3]) + 8]
-                for i in lines[start_lines[2] : end_lines[2]]
-                if 50 < float(i.split()[2]) < 275
-            ]
-        ).astype(float)
-        cool1 = np.array(
-            [
-                [float(i.split()[2]), float(i.split()[3]) + 8]
-                for i in lines[start_lines[1] : end_lines[1]]
-                if 50 < float(i.split()[2]) < 275
-            ]
-        ).astype(float)
-
-        samples.append(
-            Sample(
-                file_name,
-                file,
-                Curve(heat1.T[0], heat1.T[1]),
-                Curve(heat2.T[0], heat2.T[1]),
-                Curve(cool1.T[0], cool1.T[1], 1),
-            )
-        )
 
-    for sample in samples:
+def run_debug(files: list, params: dict = None):
+    # The peaks are shown one sample at a time, to tune find_peaks by eye
+    for file in files:
+        sample = read_sample(file)
         print(f"Analyzing: {sample.name}")
-        sample.find_curve_peaks()
+        sample.find_curve_peaks(params)
         sample.plot_curves()
 
 
+@click.command()
+@click.argument("paths", nargs=-1)
+@click.option(
+    "--jobs",
+    "-j",
+    default=os.cpu_count(),
+    type=click.IntRange(min=1),
+    help="Number of worker processes.",
+)
+@click.option("--output-dir", "-o", help="Folder for the graphs and the summary.")
+@click.option("--summary", help=f"Summary of all peaks, {METRICS_FILE} by default.")
+@click.option("--force", is_flag=True, help="Process files with up to date graphs too.")
+@click.option(
+    "--dh100", default=DH100, type=float, help="Melting enthalpy of 100 % crystals."
+)
+@click.option(
+    "--peaks",
+    default=PEAK_CONFIG,
+    help="YAML file with the find_peaks bounds, written by --tune.",
+)
+@click.option(
+    "--tune",
+    metavar="LABELS",
+    help="Find the best find_peaks bounds for the peaks listed in this CSV.",
+)
+def main(paths, jobs, output_dir, summary, force, dh100, peaks, tune):
+    """Evaluate DSC text exports (or folders and globs of them).
+    Without PATHS the files are picked in a dialog."""
+    files = find_files(paths) if paths else ask_files()
+    if not files:
+        print("No DSC files found")
+        sys.exit(2)
+    if tune:
+        results = tune_peaks(files, tune, jobs)
+        for params, cost in results[:5]:
+            print(f"    cost {cost:>8.2f}  {params}")
+        save_peak_params(results[0][0], peaks)
+        print(f"\nBest find_peaks bounds saved to {peaks}")
+        return
+    params = load_peak_params(peaks)
+    if DEBUG:
+        run_debug(files, params)
+        return
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    folder = output_dir or os.path.split(files[0])[0]
+    summary = summary or os.path.join(folder, METRICS_FILE)
+    cache_path = os.path.join(folder, CACHE_FILE)
+    cache = load_cache(cache_path)
+
+    print(f"Processing {len(files)} files\n")
+    t_start = perf_counter()
+    process = partial(
+        process_file, folder=output_dir, force=force, dh100=dh100, params=params
+    )
+    entries = {}
+    failed = []
+    skipped = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(process, file, cache.get(os.path.abspath(file)))
+            for file in files
+        ]
+        for future in as_completed(futures):
+            file, entry, error = future.result()
+            if entry is None:
+                print(f"Failed: {file}\n    {error}")
+                failed.append(file)
+                continue
+            entries[os.path.abspath(file)] = entry
+            if error == "skipped":
+                skipped += 1
+            else:
+                print(f"Analyzed: {file}")
+    cache.update(entries)
+    save_cache(cache, cache_path)
+
+    done = [os.path.abspath(file) for file in files if file not in failed]
+    table = pd.DataFrame([row for file in done for row in entries[file]["metrics"]])
+    if not table.empty:
+        write_metrics(table, summary)
+        print(f"\nPeak metrics saved to {summary}")
+        peaks = table.groupby(["sample", "curve"], sort=False)["peak"]
+        for (name, curve), temperatures in peaks:
+            text = ", ".join(f"{t:.1f}" for t in temperatures)
+            print(f"    {name:<30} {curve:<15} {text} °C")
+    total_time = perf_counter() - t_start
+    print(f"\n{len(files) - len(failed)} of {len(files)} files done", end="")
+    print(f", {skipped} were up to date")
+    print(f"The evaluation took {round(total_time, 2)} s")
+    if not paths:
+        input("\nPress any key to exit")
+    sys.exit(1 if failed else 0)
+
+
 if __name__ == "__main__":
     main()
@@ -1,27 +1,47 @@
+import csv
+import json
 import os
-import tkinter as tk
+import re
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from time import time
-from tkinter.filedialog import askopenfilenames
+from functools import lru_cache, partial
+from time import perf_counter
 
+import click
 import numpy as np
-import seaborn as sns
-from matplotlib import pyplot as plt
-from mycolorpy import colorlist as mcp
+import pandas as pd
+import yaml
+from matplotlib import colormaps
 from scipy import sparse
+from scipy.linalg import solveh_banded
+from scipy.optimize import least_squares
 from scipy.signal import find_peaks
-from scipy.sparse.linalg import spsolve
-from shapely.geometry import LineString, Polygon
 
+from waxscache import ScanCache
+from waxsplot import RENDER_FORMATS, get_canvas
 from waxsreaders import *
 
-FORMATS = {
-    "asc": get_xy_asc,
-    "itx": get_xy_itx,
-    "ras": get_xy_ras,
-    "scn": get_xy_scn,
-    "xrdml": get_xy_xrdml,
-}
+
+# 2 Theta windows searched for the peak of each crystalline phase, bounds excluded
+PHASES = [
+    {"name": "Phase I", "start": 9.5, "end": 10.3},
+    {"name": "Phase II", "start": 11.9, "end": 12.1},
+]
+PHASE_COLORS = ["b", "r", "g", "m", "c", "y"]
+# CODE name melt DD.MM.YYYY HH.MM meas DD.MM.YYYY HH.MM.ext, the name may be empty
+DATE = r"\d{1,2}\.\d{1,2}\.\d{4} \d{1,2}\.\d{2}"
+FILE_NAME = re.compile(
+    rf"^(?P<code>\S+) (?:(?P<name>.*) )?\S+ (?P<melt>{DATE}) \S+ (?P<measure>{DATE})"
+    r"\.[^.\s]+$"
+)
+DATE_FORMAT = "%d.%m.%Y %H.%M"
+# 2 Theta added on both sides of the phase windows when fitting the peaks
+FIT_MARGIN = 1.0
+# Version of the results store, raise it when the stored values or the
+# analysis behind them change, so that old results are not restored
+STORE_VERSION = 2
 
 
 class Group:
@@ -38,23 +58,31 @@ class Group:
             print(f"    Working on sample {enum}/{len(self.samples)}")
             sample.get_all_attributes()
 
+    def fit_phases(self):
+        # Going up in age, each fit starts from the result of the previous sample
+        params = None
+        for sample in sorted(self.samples, key=lambda s: s.age):
+            if sample.restored and sample.fit_params is not None:
+                params = sample.fit_params
+                continue
+            if sample.restored:
+                sample.load_arrays()
+            params = sample.fit_peaks(params)
+
     def graph_singles(self):
         for sample in self.samples:
             sample.graph()
 
-    def graph_all(self):
-        cols = mcp.gen_color(cmap="copper", n=len(self.samples))
-        sns.set_theme()
-        sns.set_style("whitegrid")
-        fig, ax = plt.subplots()
-        ax.set_title(f"{self.name}")
-        ax.set_xlabel("2 Theta [°]")
-        ax.set_ylabel("Intensity [-]")
+    def graph_all(self, folder: str = None, dpi: int = 300, fmt: str = "png"):
+        folder = folder or os.path.split(self.samples[0].path)[0]
+        cols = colormaps["copper"](np.linspace(0, 1, len(self.samples)))
+        canvas = get_canvas()
+        ax = canvas.start(f"{self.name}", "2 Theta [°]", "Intensity [-]")
         ax.set_xlim(5, 30)
         maxYs = []
         for e, sample in enumerate(self.samples):
             maxYs.append(max(sample.y))
-            plt.plot(
+            canvas.line(
                 sample.x,
                 sample.y,
                 color=cols[e],
@@ -62,46 +90,40 @@ class Group:
             )
         ax.set_ylim(0, max(maxYs) + 1000)
         ax.legend(loc="upper left")
-        plt.gcf().set_size_inches(16, 9)
-        plt.savefig(
-            f"{os.path.split(sample.path)[0]}\{self.name} (grouped).png", dpi=300
-        )
-        plt.close()
+        canvas.save(os.path.join(folder, f"{self.name} (grouped).{fmt}"), dpi=dpi)
 
-    def graph_halftime(self):
-        times = []
-        c_phases = []
-        phases_1 = []
-        phases_2 = []
-        for sample in self.samples:
-            times.append(sample.age)
-            c_phases.append(sample.crystallinity)
-            phases_1.append(sample.phase1)
-            phases_2.append(sample.phase2)
-        sns.set_theme()
-        sns.set_style("whitegrid")
-        fig, ax = plt.subplots()
-        ax.set_title(f"{self.name}")
-        ax.set_xlabel("Time [h]")
-        ax.set_ylabel("Phase ammount [%]")
+    def get_halftimes(self):
+        # Ages where the first two phases cross, with the phase amount there
+        samples = sorted(self.samples, key=lambda s: s.age)
+        times = np.array([sample.age for sample in samples], dtype=float)
+        phases = np.array([sample.phases for sample in samples], dtype=float).T
+        if len(phases) < 2:
+            self.halftimes = np.empty((0, 2))
+        else:
+            self.halftimes = find_crossings(times, phases[0], phases[1])
+        return self.halftimes
+
+    def graph_halftime(self, folder: str = None, dpi: int = 300, fmt: str = "png"):
+        folder = folder or os.path.split(self.samples[0].path)[0]
+        samples = sorted(self.samples, key=lambda s: s.age)
+        times = [sample.age for sample in samples]
+        c_phases = [sample.crystallinity for sample in samples]
+        phases = np.array([sample.phases for sample in samples]).T
+        canvas = get_canvas()
+        ax = canvas.start(f"{self.name}", "Time [h]", "Phase ammount [%]")
         ax.set_xlim(min(times), max(times))
         ax.set_ylim(0, round(max(c_phases) + 10, -1))
-        plt.plot(times, c_phases, "k-", label="Crystalline phase", alpha=0.5)
-        plt.plot(times, phases_1, "b-", label="Phase 1")
-        plt.plot(times, phases_2, "r-", label="Phase 2")
-        plt.legend(loc="upper left")
-        if (
-            len(times) > 1
-            and (phases_1[0] - phases_2[0]) * (phases_1[-1] - phases_2[-1]) < 0
-        ):
-            line1 = LineString(np.column_stack((times, phases_1)))
-            line2 = LineString(np.column_stack((times, phases_2)))
-            intersection = line1.intersection(line2)
-            xInter, yInter = intersection.xy[0][0], intersection.xy[1][0]
-            plt.plot(*intersection.xy, "ko")
-            plt.annotate(
-                f"{round(xInter, 2)}",
-                (xInter, yInter),
+        canvas.line(times, c_phases, label="Crystalline phase", alpha=0.5)
+        windows = self.samples[0].phase_windows
+        for num, window in enumerate(windows):
+            color = PHASE_COLORS[num % len(PHASE_COLORS)]
+            canvas.line(times, phases[num], color=color, label=window["name"])
+        ax.legend(loc="upper left")
+        for x_inter, y_inter in self.get_halftimes():
+            canvas.line([x_inter], [y_inter], linestyle="None", marker="o")
+            ax.annotate(
+                f"{round(x_inter, 2)}",
+                (x_inter, y_inter),
                 xytext=(-14, 10),
                 textcoords="offset points",
                 fontsize=12,
@@ -109,49 +131,46 @@ class Group:
                     facecolor="white", alpha=0.75, edgecolor="gray", boxstyle="round"
                 ),
             )
-        plt.gcf().set_size_inches(16, 9)
-        plt.savefig(
-            f"{os.path.split(sample.path)[0]}\{self.name} (halftime).png", dpi=300
-        )
-        plt.close()
+        canvas.save(os.path.join(folder, f"{self.name} (halftime).{fmt}"), dpi=dpi)
 
 
 class Sample:
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: str,
+        cache: ScanCache = None,
+        phases: list = None,
+        info: dict = None,
+    ):
         self.path = path
-        self.format = path[-3:].lower()
+        self.info = info
+        self.phase_windows = phases or PHASES
+        self.format = None
+        self.cache = cache or ScanCache(enabled=False)
+        self.error = None
+        self.fit_params = None
+        self.restored = False
 
     def get_name(self):
-        file_name = os.path.split(self.path)[1]
-        file_split = file_name.split(" ")
-        name_split = file_split[1:-6]
-        name = " ".join(str(x) for x in name_split)
-        name += " %"
-        self.name = name
+        if self.info is None:
+            self.info = parse_file_name(self.path)
+        self.name = self.info["name"]
 
     def get_age(self):
-        file_name = os.path.split(self.path)[1]
-        file_split = file_name.split(" ")
-        melt_date = file_split[-5]
-        melt_time = file_split[-4]
-        measure_date = file_split[-2]
-        measure_time = file_split[-1][:-4]
-        melt_raw = " ".join([melt_date, melt_time])
-        measure_raw = " ".join([measure_date, measure_time])
-        melt = datetime.strptime(melt_raw, "%d.%m.%Y %H.%M")
-        measure = datetime.strptime(measure_raw, "%d.%m.%Y %H.%M")
-        age = measure - melt
-        age_secs = age.total_seconds()
-        age_hours = round(age_secs / 3600, 1)
-        self.age = age_hours
+        if self.info is None:
+            self.info = parse_file_name(self.path)
+        age = self.info["measure"] - self.info["melt"]
+        self.age = round(age.total_seconds() / 3600, 1)
 
     def get_xy(self):
-        self.x, self.y = FORMATS[self.format](self.path)
+        # Sniffed in the worker, so a missing or unknown file is reported as failed
+        self.format = detect_format(self.path)
+        self.x, self.y = self.cache.read(self.path, FORMATS[self.format])
 
     def align(self):
+        self.x = np.asarray(self.x, dtype=float)
         if self.format == "itx":
-            x_move = [k - 2 for k in self.x]
-            self.x = x_move
+            self.x = self.x - 2
         peaks, peaks_info = find_peaks(
             self.y[: int(len(self.y) * 1 / 3)], width=5, height=1000, prominence=200
         )
@@ -162,174 +181,691 @@ class Sample:
             if abs(dif) < last_dif:
                 closest = dif
             last_dif = dif
-        x_aligned = [x + closest for x in self.x]
-        self.x = x_aligned
+        self.x = self.x + closest
 
     def remove_air(self):
-        y_air = np.linspace(self.y[0], self.y[-1], num=len(self.y))
-        while True:
-            difs = []
-            for i in range(0, len(self.y)):
-                dif = self.y[i] - y_air[i]
-                difs.append(dif)
-            if all(i >= 0 for i in difs):
-                break
-            else:
-                for j in range(0, len(y_air)):
-                    y_air[j] -= 1
-        y_no_air = []
-        for i in range(0, len(self.y)):
-            y_no_air.append(self.y[i] - y_air[i])
+        y = np.asarray(self.y, dtype=float)
+        y_air = np.linspace(y[0], y[-1], num=len(y))
+        # Lower the air line by whole counts until no point is under it, one
+        # count more when rounding leaves a point a hair under the lowered line
+        offset = max(0.0, np.ceil(np.max(y_air - y)))
+        offset += np.any(y - (y_air - offset) < 0)
+        y_air -= offset
         self.y_with_air = self.y
         self.air_line = y_air
-        self.y = y_no_air
+        self.y = y - y_air
 
     def get_baseline(self):
         lam = 10000
         p = 0.0001
         niter = 100
-        L = len(self.y)
-        D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(L, L - 2))
-        w = np.ones(L)
+        y = np.asarray(self.y, dtype=float)
+        penalty = penalty_bands(len(y), lam)
+        w = np.ones(len(y))
         for i in range(niter):
-            W = sparse.spdiags(w, 0, L, L)
-            Z = W + lam * D.dot(D.transpose())
-            z = spsolve(Z, w * self.y)
-            w = p * (self.y > z) + (1 - p) * (self.y < z)
+            bands = penalty.copy()
+            bands[-1] += w
+            z = solveh_banded(bands, w * y)
+            w_new = p * (y > z) + (1 - p) * (y < z)
+            # Same weights would give the same baseline on every further pass
+            if np.array_equal(w_new, w):
+                break
+            w = w_new
         self.baseline = z
 
     def get_crystallinity(self):
-        points_all = []
-        points_base = []
-        for i in range(0, len(self.x)):
-            points_all.append([self.x[i], self.y[i]])
-        points_all.append([self.x[0], self.y[0]])
-        polygon_all = Polygon(points_all)
-        area_all = polygon_all.area
-        for i in range(0, len(self.x)):
-            points_base.append([self.x[i], self.baseline[i]])
-        points_base.append([self.x[0], self.baseline[0]])
-        polygon_base = Polygon(points_base)
-        area_base = polygon_base.area
+        area_all = closed_area(self.x, self.y)
+        area_base = closed_area(self.x, self.baseline)
         crystalline_area = 100 * (1 - (area_base / area_all))
         crystalline_area = round(crystalline_area, 1)
         self.crystallinity = crystalline_area
 
     def get_peaks(self):
-        phase_1_max = 0
-        phase_2_max = 0
-        peak_1_coords = []
-        peak_2_coords = []
-        for i in range(0, len(self.x)):
-            if 9.5 < self.x[i] < 10.3:
-                if self.y[i] > phase_1_max:
-                    phase_1_max = self.y[i]
-                    peak_1_coords = [self.x[i], self.y[i]]
-            if 11.9 < self.x[i] < 12.1:
-                if self.y[i] > phase_2_max:
-                    phase_2_max = self.y[i]
-                    peak_2_coords = [self.x[i], self.y[i]]
-        phase_1_percent = round(
-            phase_1_max / (phase_1_max + phase_2_max) * self.crystallinity, 1
-        )
-        phase_2_percent = round(
-            phase_2_max / (phase_1_max + phase_2_max) * self.crystallinity, 1
+        # Positions of the window bounds on the sorted 2 Theta axis
+        bounds_start = [window["start"] for window in self.phase_windows]
+        bounds_end = [window["end"] for window in self.phase_windows]
+        starts = np.searchsorted(self.x, bounds_start, side="right")
+        ends = np.searchsorted(self.x, bounds_end, side="left")
+        maxima = []
+        self.peaks = []
+        for start, end in zip(starts, ends):
+            if end > start and np.max(self.y[start:end]) > 0:
+                index = start + int(np.argmax(self.y[start:end]))
+                self.peaks.append((index, self.x[index], self.y[index]))
+                maxima.append(self.y[index])
+            else:
+                self.peaks.append(None)
+                maxima.append(0)
+        if sum(maxima) == 0:
+            raise ValueError("No peaks found in any of the phase windows")
+        self.phases = [
+            round(maximum / sum(maxima) * self.crystallinity, 1) for maximum in maxima
+        ]
+
+    def fit_peaks(self, start=None):
+        windows = self.phase_windows
+        lower = min(window["start"] for window in windows) - FIT_MARGIN
+        upper = max(window["end"] for window in windows) + FIT_MARGIN
+        mask = (self.x > lower) & (self.x < upper)
+        x = self.x[mask]
+        y = (self.y - self.baseline)[mask]
+        # One pseudo-Voigt per phase: amplitude, center, FWHM, Lorentzian share
+        bounds_low = []
+        bounds_high = []
+        guess = []
+        for window, peak in zip(windows, self.peaks):
+            width = window["end"] - window["start"]
+            bounds_low += [0, window["start"], 0.01, 0]
+            bounds_high += [np.inf, window["end"], 2 + 4 * width, 1]
+            if peak is None:
+                center = (window["start"] + window["end"]) / 2
+                guess += [1, center, width, 0.5]
+            else:
+                index, peak_x, _ = peak
+                height = self.y[index] - self.baseline[index]
+                guess += [max(height, 1), peak_x, width, 0.5]
+        if start is not None:
+            guess = start
+        guess = np.clip(guess, bounds_low, bounds_high)
+        result = least_squares(
+            lambda p: pseudo_voigt(x, p)[0] - y,
+            guess,
+            jac=lambda p: pseudo_voigt(x, p)[1],
+            bounds=(bounds_low, bounds_high),
         )
-        self.phase1 = phase_1_percent
-        self.phase2 = phase_2_percent
-        self.peak1 = peak_1_coords
-        self.peak2 = peak_2_coords
+        self.fit_params = result.x
+        self.fit_range = (lower, upper)
+        self.fit_evaluations = result.nfev
+        areas = pseudo_voigt_area(result.x)
+        self.phases = [
+            round(area / np.sum(areas) * self.crystallinity, 1) for area in areas
+        ]
+        return result.x
+
+    def load_arrays(self):
+        # Curves of a sample restored from a results store, which only keeps
+        # the values computed from them
+        for step in (self.get_xy, self.align, self.remove_air, self.get_baseline):
+            step()
 
     def get_all_attributes(self):
-        self.get_name()
-        self.get_age()
-        self.get_xy()
-        self.align()
-        self.remove_air()
-        self.get_baseline()
-        self.get_crystallinity()
-        self.get_peaks()
-
-    def graph(self):
-        sns.set_theme()
-        sns.set_style("whitegrid")
-        fig, ax = plt.subplots()
-        ax.set_title(f"{self.name}\nAged {self.age} hours")
-        ax.set_xlabel("2 Theta [°]")
-        ax.set_ylabel("Intensity [-]")
+        self.timings = {}
+        steps = [
+            self.get_name,
+            self.get_age,
+            self.get_xy,
+            self.align,
+            self.remove_air,
+            self.get_baseline,
+            self.get_crystallinity,
+            self.get_peaks,
+        ]
+        for step in steps:
+            t_start = perf_counter()
+            step()
+            self.timings[step.__name__] = perf_counter() - t_start
+
+    def graph(self, folder: str = None, dpi: int = 300, fmt: str = "png"):
+        folder = folder or os.path.split(self.path)[0]
+        canvas = get_canvas()
+        ax = canvas.start(
+            f"{self.name}\nAged {self.age} hours", "2 Theta [°]", "Intensity [-]"
+        )
         ax.set_xlim(5, 30)
         ax.set_ylim(0, max(self.y))
-        plt.plot(
-            self.x, self.y_with_air, "k-", label="Source data with air", alpha=0.25
+        canvas.line(self.x, self.y_with_air, label="Source data with air", alpha=0.25)
+        canvas.line(self.x, self.y, label="Source data")
+        canvas.line(self.x, self.baseline, color="b", label="Baseline")
+        if self.fit_params is not None:
+            mask = (self.x > self.fit_range[0]) & (self.x < self.fit_range[1])
+            fitted = pseudo_voigt(self.x[mask], self.fit_params)[0]
+            canvas.line(
+                self.x[mask],
+                self.baseline[mask] + fitted,
+                color="g",
+                linestyle="--",
+                label="Fitted peaks",
+            )
+        legend_text = f"Crystalline: {self.crystallinity} %"
+        for window, phase, peak in zip(self.phase_windows, self.phases, self.peaks):
+            legend_text += f"\n{window['name']}: {phase} %"
+            if peak is None:
+                continue
+            index, peak_x, peak_y = peak
+            canvas.line([peak_x], [peak_y], color="r", linestyle="None", marker="x")
+            canvas.line([peak_x, peak_x], [self.baseline[index], peak_y], color="r")
+        ax.legend(title=legend_text, loc="upper left")
+        canvas.save(
+            os.path.join(folder, f"{self.name} (Aged {self.age} hours).{fmt}"),
+            dpi=dpi,
         )
-        plt.plot(self.x, self.y, "k-", label="Source data")
-        plt.plot(self.x, self.baseline, "b-", label="Baseline")
-        plt.plot(self.peak1[0], self.peak1[1], "xr")
-        plt.plot(self.peak2[0], self.peak2[1], "xr")
-        peak_1_index = self.x.index(self.peak1[0])
-        peak_2_index = self.x.index(self.peak2[0])
-        plt.plot(
-            [self.peak1[0], self.peak1[0]],
-            [self.baseline[peak_1_index], self.peak1[1]],
-            "r-",
+
+
+def pseudo_voigt(x, params):
+    # Sum of pseudo-Voigt peaks and its Jacobian, params go in fours per peak
+    amplitude, center, fwhm, eta = np.reshape(params, (-1, 4)).T
+    u = (x[:, None] - center) / fwhm
+    gauss = np.exp(-4 * np.log(2) * u**2)
+    lorentz = 1 / (1 + 4 * u**2)
+    shape = (1 - eta) * gauss + eta * lorentz
+    slope = -8 * u * ((1 - eta) * np.log(2) * gauss + eta * lorentz**2)
+    jacobian = np.empty((len(x), len(center), 4))
+    jacobian[..., 0] = shape
+    jacobian[..., 1] = -amplitude * slope / fwhm
+    jacobian[..., 2] = -amplitude * slope * u / fwhm
+    jacobian[..., 3] = amplitude * (lorentz - gauss)
+    return (amplitude * shape).sum(axis=1), jacobian.reshape(len(x), -1)
+
+
+def pseudo_voigt_area(params):
+    amplitude, center, fwhm, eta = np.reshape(params, (-1, 4)).T
+    gauss_area = np.sqrt(np.pi / (4 * np.log(2)))
+    return amplitude * fwhm * ((1 - eta) * gauss_area + eta * np.pi / 2)
+
+
+def find_crossings(x, a, b):
+    # Every point where the polylines a(x) and b(x) meet, linearly interpolated
+    # between the neighbouring points, as rows of [x, value]
+    difference = a - b
+    sign = np.sign(difference)
+    left = np.nonzero(sign[:-1] * sign[1:] < 0)[0]
+    share = difference[left] / (difference[left] - difference[left + 1])
+    x_cross = x[left] + share * (x[left + 1] - x[left])
+    y_cross = a[left] + share * (a[left + 1] - a[left])
+    touching = np.nonzero(difference == 0)[0]
+    crossings = np.column_stack(
+        (np.append(x_cross, x[touching]), np.append(y_cross, a[touching]))
+    )
+    return crossings[np.argsort(crossings[:, 0], kind="stable")]
+
+
+def closed_area(x, y):
+    # Trapezoids under every segment, including the one closing the curve back
+    # to its first point, which is the same area as a polygon made of the points
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_next = np.roll(x, -1)
+    y_next = np.roll(y, -1)
+    return abs(np.sum((x_next - x) * (y_next + y)) / 2)
+
+
+@lru_cache(maxsize=16)
+def penalty_bands(length: int, lam: float):
+    # lam * D.D^T of the second differences in the upper banded form of solveh_banded
+    D = sparse.diags([1.0, -2.0, 1.0], [0, -1, -2], shape=(length, length - 2))
+    penalty = lam * (D @ D.transpose())
+    bands = np.zeros((3, length))
+    bands[0, 2:] = penalty.diagonal(2)
+    bands[1, 1:] = penalty.diagonal(1)
+    bands[2] = penalty.diagonal(0)
+    bands.flags.writeable = False
+    return bands
+
+
+def analyze_sample(sample: Sample):
+    # One broken file should not stop a whole batch, the error is reported at the end
+    try:
+        sample.get_all_attributes()
+    except Exception as error:
+        sample.error = f"{type(error).__name__}: {error}"
+    return sample
+
+
+def fit_group(group: Group):
+    group.fit_phases()
+    return group
+
+
+def render_sample(sample: Sample, **options):
+    sample.graph(**options)
+
+
+def load_sample(sample: Sample):
+    sample.load_arrays()
+    return sample
+
+
+def load_groups(groups: list, jobs: int):
+    # Curves of the restored samples, for the graphs and the study table
+    pending = [s for g in groups for s in g.samples if s.restored]
+    loaded = dict(zip(map(id, pending), run_tasks(load_sample, pending, jobs)))
+    for group in groups:
+        group.samples = [loaded.get(id(s), s) for s in group.samples]
+
+
+def render_group(group: Group, **options):
+    group.graph_all(**options)
+    group.graph_halftime(**options)
+
+
+def run_tasks(func, items: list, jobs: int, initializer=None, initargs=()):
+    # Results come back in the order of items, progress is printed as they finish
+    results = [None] * len(items)
+    if jobs == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for num, item in enumerate(items):
+            results[num] = func(item)
+            print(f"    Done {num + 1}/{len(items)}")
+        return results
+    with ProcessPoolExecutor(jobs, initializer=initializer, initargs=initargs) as pool:
+        futures = {pool.submit(func, item): num for num, item in enumerate(items)}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            print(f"    Done {done}/{len(items)}")
+    return results
+
+
+def analyze_groups(groups: list, jobs: int):
+    # Only samples not restored from a store are analyzed,
+    # failed ones are left out of their groups and returned separately
+    pending = [s for g in groups for s in g.samples if not s.restored]
+    analyzed = dict(zip(map(id, pending), run_tasks(analyze_sample, pending, jobs)))
+    for group in groups:
+        group.samples = [analyzed.get(id(s), s) for s in group.samples]
+        group.samples = [s for s in group.samples if s.error is None]
+    groups[:] = [group for group in groups if group.samples]
+    samples = list(analyzed.values())
+    return [s for s in samples if s.error is None], [s for s in samples if s.error]
+
+
+def render_groups(samples: list, groups: list, jobs: int, **options):
+    # Every worker draws on its own reused canvas, see waxsplot
+    run_tasks(partial(render_sample, **options), samples, jobs)
+    run_tasks(partial(render_group, **options), groups, jobs)
+
+
+class ResultStore:
+    # SQLite file with the values of the analysed samples and the members of
+    # each group, so that an incremental run only works on what is new
+    def __init__(self, path: str, settings: dict):
+        self.connection = sqlite3.connect(path)
+        settings = {**settings, "version": STORE_VERSION}
+        self.settings = json.dumps(settings, sort_keys=True)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != STORE_VERSION:
+            self.connection.executescript(
+                "DROP TABLE IF EXISTS samples; DROP TABLE IF EXISTS groups;"
+            )
+        self.connection.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS samples (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER,
+                settings TEXT, code TEXT, age REAL, crystallinity REAL,
+                phases TEXT, peaks TEXT, fit_params TEXT
+            );
+            CREATE TABLE IF NOT EXISTS groups (
+                code TEXT PRIMARY KEY, settings TEXT, members TEXT
+            );
+            PRAGMA user_version = {STORE_VERSION};
+            """
         )
-        plt.plot(
-            [self.peak2[0], self.peak2[0]],
-            [self.baseline[peak_2_index], self.peak2[1]],
-            "r-",
+
+    def restore(self, sample: Sample):
+        try:
+            stat = os.stat(sample.path)
+        except OSError:
+            return False
+        row = self.connection.execute(
+            "SELECT age, crystallinity, phases, peaks, fit_params FROM samples"
+            " WHERE path = ? AND mtime_ns = ? AND size = ? AND settings = ?",
+            (
+                os.path.abspath(sample.path),
+                stat.st_mtime_ns,
+                stat.st_size,
+                self.settings,
+            ),
+        ).fetchone()
+        if row is None:
+            return False
+        sample.age, sample.crystallinity = row[0], row[1]
+        sample.phases = json.loads(row[2])
+        sample.peaks = [None if p is None else tuple(p) for p in json.loads(row[3])]
+        fit_params = json.loads(row[4])
+        sample.fit_params = None if fit_params is None else np.array(fit_params)
+        sample.restored = True
+        return True
+
+    def save(self, group: Group, sample: Sample):
+        stat = os.stat(sample.path)
+        peaks = [
+            None if peak is None else [int(peak[0]), float(peak[1]), float(peak[2])]
+            for peak in sample.peaks
+        ]
+        fit_params = None if sample.fit_params is None else sample.fit_params.tolist()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                os.path.abspath(sample.path),
+                stat.st_mtime_ns,
+                stat.st_size,
+                self.settings,
+                group.code,
+                sample.age,
+                sample.crystallinity,
+                json.dumps([float(p) for p in sample.phases]),
+                json.dumps(peaks),
+                json.dumps(fit_params),
+            ),
         )
-        legend_text = f"Crystalline: {self.crystallinity} %\nPhase  I: {self.phase1} %\nPhase II: {self.phase2} %"
-        ax.legend(title=legend_text, loc="upper left")
-        plt.gcf().set_size_inches(16, 9)
-        plt.savefig(
-            f"{os.path.split(self.path)[0]}\{self.name} (Aged {self.age} hours).png",
-            dpi=300,
+
+    def members(self, group: Group):
+        return json.dumps(sorted(os.path.abspath(s.path) for s in group.samples))
+
+    def group_changed(self, group: Group):
+        # New or removed members, or members analyzed again after a change
+        if not all(s.restored for s in group.samples):
+            return True
+        row = self.connection.execute(
+            "SELECT members FROM groups WHERE code = ? AND settings = ?",
+            (group.code, self.settings),
+        ).fetchone()
+        return row is None or row[0] != self.members(group)
+
+    def save_group(self, group: Group):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO groups VALUES (?, ?, ?)",
+            (group.code, self.settings, self.members(group)),
+        )
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def print_timings(samples: list):
+    if not samples:
+        return
+    print("Time spent in each step (summed over all samples):")
+    for step in samples[0].timings:
+        step_time = sum(sample.timings[step] for sample in samples)
+        print(f"    {step:<20} {step_time:>9.2f} s")
+
+
+def load_phases(path: str):
+    with open(path) as f:
+        phases = yaml.safe_load(f)["phases"]
+    for window in phases:
+        if not window["start"] < window["end"]:
+            raise ValueError(f"Phase window {window['name']} ends before it starts")
+    return phases
+
+
+def parse_file_name(path: str):
+    file_name = os.path.split(path)[1]
+    match = FILE_NAME.match(file_name)
+    if match is None:
+        raise ValueError(
+            f"Malformed file name {file_name!r}, expected "
+            "'CODE name melt DD.MM.YYYY HH.MM meas DD.MM.YYYY HH.MM.ext'"
         )
-        plt.close()
+    try:
+        melt = datetime.strptime(match["melt"], DATE_FORMAT)
+        measure = datetime.strptime(match["measure"], DATE_FORMAT)
+    except ValueError as e:
+        raise ValueError(f"Malformed date in file name {file_name!r}: {e}") from None
+    return {
+        "code": match["code"],
+        "name": f"{match['name'] or ''} %",
+        "melt": melt,
+        "measure": measure,
+    }
 
 
-def make_groups(files: list):
-    groups = []
+def make_groups(files: list, cache: ScanCache = None, phases: list = None):
+    # Returns the groups by sample code and the files with unreadable names
+    groups = {}
+    malformed = []
     for file in files:
-        file_name = os.path.split(file)[1]
-        file_split = file_name.split(" ")
-        code = file_split[0]
-        name_split = file_split[1:-6]
-        name = " ".join(str(x) for x in name_split)
-        name += " %"
-        if not any(group.code == code for group in groups):
-            groups.append(Group(code, name))
-        group_obj = [group for group in groups if group.code == code][0]
-        group_obj.add_sample(Sample(file))
-    return groups
+        try:
+            info = parse_file_name(file)
+        except ValueError as e:
+            malformed.append((file, e))
+            continue
+        group = groups.get(info["code"])
+        if group is None:
+            group = groups[info["code"]] = Group(info["code"], info["name"])
+        group.add_sample(Sample(file, cache, phases, info))
+    return list(groups.values()), malformed
 
 
-if __name__ == "__main__":
+def study_frame(groups: list):
+    # One row per measured point, the per sample values repeated on each row
+    samples = [(group, sample) for group in groups for sample in group.samples]
+    lengths = [len(sample.x) for _, sample in samples]
+
+    def per_sample(values):
+        return np.repeat(values, lengths)
+
+    def per_point(attribute):
+        return np.concatenate([getattr(sample, attribute) for _, sample in samples])
+
+    phases = np.array([s.phases for _, s in samples]).T
+    return pd.DataFrame(
+        {
+            "group": pd.Categorical(per_sample([g.code for g, _ in samples])),
+            "group_name": pd.Categorical(per_sample([g.name for g, _ in samples])),
+            "scan": per_sample(np.arange(len(samples))),
+            "file": pd.Categorical(
+                per_sample([os.path.split(s.path)[1] for _, s in samples])
+            ),
+            "age": per_sample([s.age for _, s in samples]),
+            "crystallinity": per_sample([s.crystallinity for _, s in samples]),
+            **{f"phase{n}": per_sample(p) for n, p in enumerate(phases, 1)},
+            "x": per_point("x"),
+            "y": per_point("y"),
+            "y_with_air": per_point("y_with_air"),
+            "air_line": per_point("air_line"),
+            "baseline": per_point("baseline"),
+        }
+    )
+
+
+def export_study(groups: list, path: str):
+    study_frame(groups).to_parquet(path, index=False)
+
+
+def read_manifest(path: str):
+    # Paths in the manifest are relative to the manifest itself
+    folder = os.path.split(os.path.abspath(path))[0]
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    if rows and "path" not in rows[0]:
+        raise click.BadParameter("Needs a 'path' column", param_hint="--manifest")
+    return [os.path.join(folder, row["path"]) for row in rows if row["path"]]
+
+
+def ask_files():
+    import tkinter as tk
+    from tkinter.filedialog import askopenfilenames
+
     root = tk.Tk()
     root.withdraw()
     print("\nSelect the RTG data files")
-    files = askopenfilenames(
+    return askopenfilenames(
         title="Select the files with RTG data",
         filetypes=[("RTG data files", ".asc .itx .ras .scn .xrdml")],
     )
-    files_grouped = make_groups(files)
+
+
+@click.command()
+@click.argument("paths", nargs=-1)
+@click.option(
+    "--manifest",
+    type=click.Path(exists=True, dir_okay=False),
+    help="CSV file with a 'path' column listing the files.",
+)
+@click.option(
+    "--output-dir",
+    "-o",
+    type=click.Path(file_okay=False),
+    help="Folder for the graphs, next to the data files by default.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    default=os.cpu_count(),
+    type=click.IntRange(min=1),
+    help="Number of worker processes.",
+)
+@click.option(
+    "--dpi",
+    default=300,
+    type=click.IntRange(min=1),
+    help="Resolution of the graphs, lower it for quick previews.",
+)
+@click.option(
+    "--format",
+    "fmt",
+    default="png",
+    type=click.Choice(RENDER_FORMATS),
+    help="File type of the graphs, svg and pdf are vector images.",
+)
+@click.option(
+    "--phases",
+    type=click.Path(exists=True, dir_okay=False),
+    help="YAML file with the 2 Theta window of each phase.",
+)
+@click.option(
+    "--fit",
+    is_flag=True,
+    help="Split the phases by fitted peak areas instead of peak heights.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only analyze and graph files not in the results store yet.",
+)
+@click.option(
+    "--store",
+    type=click.Path(dir_okay=False),
+    help="Results file of --incremental, pb_blends.sqlite in the output folder.",
+)
+@click.option("--no-cache", is_flag=True, help="Parse every file again.")
+@click.option("--clear-cache", is_flag=True, help="Empty the parsed scan cache.")
+@click.option(
+    "--export",
+    type=click.Path(dir_okay=False),
+    help="Save the whole study as one .parquet table.",
+)
+def main(
+    paths,
+    manifest,
+    output_dir,
+    jobs,
+    dpi,
+    fmt,
+    phases,
+    fit,
+    incremental,
+    store,
+    no_cache,
+    clear_cache,
+    export,
+):
+    """Analyze WAXS data of PB blends, grouped by the sample code.
+    PATHS can be files, folders or globs. Without PATHS or --manifest
+    the files are picked in a dialog."""
+    if export and os.path.splitext(export)[1].lower() != ".parquet":
+        raise click.BadParameter("Use a .parquet file", param_hint="--export")
+    cache = ScanCache(enabled=not no_cache)
+    if clear_cache:
+        cache.clear()
+
+    headless = bool(paths or manifest)
+    if headless:
+        files = find_files(paths)
+        if manifest:
+            files += read_manifest(manifest)
+    else:
+        files = ask_files()
+    if not files:
+        print("No RTG data files found")
+        sys.exit(2)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    phase_windows = load_phases(phases) if phases else PHASES
+    files_grouped, malformed = make_groups(files, cache, phase_windows)
     print(f"\nWorking on {len(files)} files")
     print(f"Found {len(files_grouped)} groups")
     print("------------------------------------------------------")
     for group in files_grouped:
         print(f"{group.name:<35}          ({len(group.samples)} files)")
     print("------------------------------------------------------\n")
-    t_start = time()
+    results = None
+    restored = 0
+    if incremental:
+        store = store or os.path.join(
+            output_dir or os.path.split(files[0])[0], "pb_blends.sqlite"
+        )
+        # The graph options are part of the settings, so changing them draws
+        # the graphs of the stored samples again in the new place or format
+        settings = {
+            "phases": phase_windows,
+            "fit": fit,
+            "output_dir": output_dir and os.path.abspath(output_dir),
+            "dpi": dpi,
+            "format": fmt,
+        }
+        results = ResultStore(store, settings)
+        restored = sum(results.restore(s) for g in files_grouped for s in g.samples)
+        print(f"{restored} samples restored from {store}")
+    t_start = perf_counter()
+    print(f"Analyzing {len(files) - restored} samples")
+    samples, failed = analyze_groups(files_grouped, jobs)
+    cache.trim()
+    t_fitted = t_analyzed = perf_counter()
+    if fit:
+        print(f"Fitting the phase peaks of {len(files_grouped)} groups")
+        files_grouped[:] = run_tasks(fit_group, files_grouped, jobs)
+        t_fitted = perf_counter()
     for group in files_grouped:
-        print(f"Working on group {group.name}")
-        group.analyze_singles()
-        group.graph_singles()
-        group.graph_all()
-        group.graph_halftime()
-        print(f"Group {group.name} done\n")
-    t_end = time()
+        for halftime, amount in group.get_halftimes():
+            print(f"{group.name}: phases cross at {halftime:.2f} h ({amount:.1f} %)")
+    samples = [s for g in files_grouped for s in g.samples if not s.restored]
+    changed = files_grouped
+    if results is not None:
+        changed = [g for g in files_grouped if results.group_changed(g)]
+    print(f"Rendering graphs of {len(changed)} groups")
+    if results is not None:
+        load_groups(changed, jobs)
+    render_groups(samples, changed, jobs, folder=output_dir, dpi=dpi, fmt=fmt)
+    if results is not None:
+        for group in files_grouped:
+            for sample in group.samples:
+                if not sample.restored:
+                    results.save(group, sample)
+            results.save_group(group)
+        results.close()
+    t_end = perf_counter()
     total_time = t_end - t_start
     print(f"All files done\n\nThe analysis took {round(total_time/60, 2)} minutes.")
-    print(f"Average time per file: {round(total_time/len(files), 2)} seconds.")
-    input("\nPress any key to exit")
-    os.startfile(os.path.split(files[0])[0])
+    print(f"    Analysis  {t_analyzed - t_start:>9.2f} s")
+    if fit:
+        print(f"    Fitting   {t_fitted - t_analyzed:>9.2f} s")
+    print(f"    Rendering {t_end - t_fitted:>9.2f} s")
+    print_timings(samples)
+    if failed:
+        print(f"\n{len(failed)} files could not be analyzed:")
+        for sample in failed:
+            print(f"    {sample.path}\n        {sample.error}")
+    if malformed:
+        print(f"\n{len(malformed)} files were skipped:")
+        for file, error in malformed:
+            print(f"    {file}\n        {error}")
+    if export and not files_grouped:
+        print(f"\nNo samples were analyzed, {export} not saved")
+    elif export:
+        if results is not None:
+            load_groups(files_grouped, jobs)
+        export_study(files_grouped, export)
+        print(f"\nStudy saved to {export}")
+    if not headless:
+        input("\nPress any key to exit")
+        if hasattr(os, "startfile"):
+            os.startfile(output_dir or os.path.split(files[0])[0])
+    sys.exit(1 if failed or malformed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,92 @@
-import tkinter as tk
-from tkinter.filedialog import askopenfilenames
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from time import perf_counter
 
+import click
+import numpy as np
+
+from waxscache import ScanCache
 from waxsreaders import *
 
-FORMATS = {
-    "asc": get_xy_asc,
-    "itx": get_xy_itx,
-    "ras": get_xy_ras,
-    "scn": get_xy_scn,
-    "xrdml": get_xy_xrdml,
-}
-
-print("Select the files with RTG data\n")
-
-root = tk.Tk()
-root.withdraw()
-files = askopenfilenames(
-    title="Select the files with RTG data",
-    filetypes=[("RTG data files", ".asc .itx .ras .scn .xrdml")],
-)
 
-for file in files:
-    print(f"Working on file: {file}")
+def write_txt(path: str, x, y):
+    # Same layout as the instrument exports, a four digit exponent on x
+    x_text = np.char.mod("%.14E", x)
+    x_text = np.char.replace(x_text, "E+", "E+00")
+    x_text = np.char.replace(x_text, "E-", "E-00")
+    y_text = np.char.mod("%.15g", y)
+    np.savetxt(path, np.column_stack((x_text, y_text)), fmt="%s", delimiter="  ")
+
+
+def convert_file(file: str, cache: ScanCache):
     new_file = ".".join(file.split(".")[:-1]) + ".txt"
-    filetype = file.split(".")[-1].lower()
     try:
-        x_list, y_list = FORMATS[filetype](file)
+        x, y = cache.read(file, FORMATS[detect_format(file)])
     except ValueError:
-        print(" Couldn't read file. Skipping to next one.")
-        continue
-    x_math_list = []
-    for x in x_list:
-        formatted = "{:.14E}".format(x)
-        parts = formatted.split("E+")
-        number = parts[0]
-        exponent = parts[1]
-        new_exponent = exponent.rjust(4, "0")
-        new_x = f"{number}E+{new_exponent}"
-        x_math_list.append(new_x)
-    xy_list = list(zip(x_math_list, y_list))
-    with open(new_file, "w") as f:
-        for pair in xy_list:
-            x, y = pair
-            line = f"{x}  {y}\n"
-            f.write(line)
-
-print("\nDone\nPress any key to exit")
-input()
+        return file, None
+    write_txt(new_file, x, y)
+    return file, new_file
+
+
+def ask_files():
+    import tkinter as tk
+    from tkinter.filedialog import askopenfilenames
+
+    print("Select the files with RTG data\n")
+    root = tk.Tk()
+    root.withdraw()
+    return askopenfilenames(
+        title="Select the files with RTG data",
+        filetypes=[("RTG data files", ".asc .itx .ras .scn .xrdml")],
+    )
+
+
+@click.command()
+@click.argument("paths", nargs=-1)
+@click.option(
+    "--jobs",
+    "-j",
+    default=os.cpu_count(),
+    type=click.IntRange(min=1),
+    help="Number of worker processes.",
+)
+@click.option("--no-cache", is_flag=True, help="Parse every file again.")
+@click.option("--clear-cache", is_flag=True, help="Empty the parsed scan cache.")
+def main(paths, jobs, no_cache, clear_cache):
+    """Convert WAXS files (or folders and globs of them) to TXT.
+    Without PATHS the files are picked in a dialog."""
+    cache = ScanCache(enabled=not no_cache)
+    if clear_cache:
+        cache.clear()
+    files = find_files(paths) if paths else ask_files()
+
+    t_start = perf_counter()
+    failed = 0
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            chunk = max(1, len(files) // (jobs * 4))
+            results = list(
+                pool.map(convert_file, files, repeat(cache), chunksize=chunk)
+            )
+    else:
+        results = map(convert_file, files, repeat(cache))
+    for file, new_file in results:
+        if new_file is None:
+            print(f"Couldn't read file: {file}")
+            failed += 1
+        else:
+            print(f"Converted file: {file}")
+    cache.trim()
+    total_time = perf_counter() - t_start
+
+    print(f"\nDone, {len(files) - failed} of {len(files)} files converted")
+    if total_time > 0:
+        print(f"{round(len(files) / total_time, 1)} files per second")
+    if not paths:
+        print("Press any key to exit")
+        input()
+
+
+if __name__ == "__main__":
+    main()
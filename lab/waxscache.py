@@ -0,0 +1,87 @@
+import hashlib
+import os
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "waxs")
+CACHE_SIZE = 1024**3
+# Part of every key, raise it when a reader in waxsreaders changes its output
+# so that scans parsed by the old code are not served again
+CACHE_VERSION = 2
+
+
+class ScanCache:
+    def __init__(
+        self, folder: str = CACHE_DIR, max_bytes: int = CACHE_SIZE, enabled=True
+    ):
+        self.folder = folder
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+
+    def key(self, path: str, reader):
+        stat = os.stat(path)
+        raw = (
+            f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+            f"|{reader.__name__}|{CACHE_VERSION}"
+        )
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def read(self, path: str, reader):
+        if not self.enabled:
+            return reader(path)
+        entry = os.path.join(self.folder, f"{self.key(path, reader)}.npz")
+        try:
+            with np.load(entry) as data:
+                x, y = data["x"], data["y"]
+        except (OSError, KeyError, ValueError):
+            pass
+        else:
+            # Touching the entry keeps the least recently used ones first in line
+            try:
+                os.utime(entry)
+            except OSError:
+                pass
+            return x, y
+        x, y = reader(path)
+        x, y = np.asarray(x), np.asarray(y)
+        # A cache that can't be written only costs the parsing next time
+        try:
+            self.write(entry, x, y)
+        except OSError:
+            pass
+        return x, y
+
+    def write(self, entry: str, x, y):
+        os.makedirs(self.folder, exist_ok=True)
+        temp = f"{entry}.{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            np.savez(f, x=x, y=y)
+        os.replace(temp, entry)
+
+    def entries(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return [e for e in os.scandir(self.folder) if e.name.endswith(".npz")]
+
+    def trim(self):
+        # Called once after a batch (in the parent, not in each worker) so that
+        # the cache folder is listed once per run instead of once per new scan
+        if not self.enabled:
+            return
+        entries = [(e, e.stat()) for e in self.entries()]
+        size = sum(stat.st_size for _, stat in entries)
+        if size <= self.max_bytes:
+            return
+        entries.sort(key=lambda item: item[1].st_mtime)
+        for e, stat in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(e.path)
+            except OSError:
+                continue
+            size -= stat.st_size
+
+    def clear(self):
+        for e in self.entries():
+            os.remove(e.path)
@@ -0,0 +1,85 @@
+import numpy as np
+import seaborn as sns
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+RENDER_FORMATS = ["png", "svg", "pdf"]
+
+_canvas = None
+
+
+class Canvas:
+    # One Agg figure reused for every graph, the lines of the previous graph
+    # are hidden and get new data instead of being plotted again
+    def __init__(self, width: float = 16, height: float = 9):
+        sns.set_theme()
+        sns.set_style("whitegrid")
+        self.figure = Figure(figsize=(width, height))
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.lines = []
+        self.used = 0
+
+    def start(self, title: str, xlabel: str, ylabel: str):
+        for line in self.lines:
+            line.set_visible(False)
+            line.set_label("_nolegend_")
+        for artist in list(self.ax.texts) + list(self.ax.collections):
+            artist.remove()
+        if self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+        self.used = 0
+        self.ax.set_title(title)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        return self.ax
+
+    def line(
+        self,
+        x,
+        y,
+        color="k",
+        linestyle="-",
+        marker="None",
+        alpha=1.0,
+        label="_nolegend_",
+    ):
+        if self.used == len(self.lines):
+            self.lines.append(self.ax.plot([], [])[0])
+        line = self.lines[self.used]
+        self.used += 1
+        line.set_data(x, y)
+        line.set(
+            color=color,
+            linestyle=linestyle,
+            marker=marker,
+            alpha=alpha,
+            label=label,
+            visible=True,
+        )
+        return line
+
+    def save(self, path: str, dpi: int = 300):
+        self.figure.savefig(path, dpi=dpi)
+
+
+def get_canvas():
+    # Each process draws on its own canvas, made on first use
+    global _canvas
+    if _canvas is None:
+        _canvas = Canvas()
+    return _canvas
+
+
+def decimate(x, y, columns: int):
+    # Keeps the lowest and highest point of every pixel column, so peaks
+    # survive while a curve is drawn with only 2 points per column
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) <= 2 * columns:
+        return x, y
+    edges = np.linspace(x[0], x[-1], columns + 1)
+    starts = np.unique(np.searchsorted(x, edges[:-1]))
+    low = np.minimum.reduceat(y, starts)
+    high = np.maximum.reduceat(y, starts)
+    return np.repeat(x[starts], 2), np.column_stack((low, high)).ravel()
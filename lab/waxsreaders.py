@@ -1,94 +1,182 @@
-def get_xy_asc(path: str):
-    lines = []
+import glob
+import mmap
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# Readers by format name and the sniffers used to recognise them, in order
+FORMATS = {}
+SNIFFERS = []
+HEAD_SIZE = 4096
+
+
+def register_format(name: str, reader, sniff=None):
+    FORMATS[name] = reader
+    if sniff is not None:
+        SNIFFERS.append((name, sniff))
+
+
+def detect_format(path: str):
+    with open(path, "rb") as f:
+        head = f.read(HEAD_SIZE)
+    for name, sniff in SNIFFERS:
+        if sniff(head):
+            return name
+    extension = path.split(".")[-1].lower()
+    if extension in FORMATS:
+        return extension
+    raise ValueError(f"Unknown WAXS data format: {path}")
+
+
+def read_xy(path: str):
+    return FORMATS[detect_format(path)](path)
+
+
+def find_files(patterns: tuple):
+    files = []
+    for pattern in patterns:
+        # Files named explicitly are sniffed whatever their extension
+        if os.path.isfile(pattern):
+            files.append(pattern)
+            continue
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for file in sorted(glob.glob(pattern, recursive=True)):
+            if file.split(".")[-1].lower() in FORMATS:
+                files.append(file)
+    return list(dict.fromkeys(files))
+
+
+def _columns(lines: list, usecols=(0, 1)):
+    data = np.loadtxt(lines, usecols=usecols, ndmin=2, dtype=np.float64)
+    return data[:, 0], data[:, 1]
+
+
+def read_asc(path: str):
     with open(path, "r") as f:
-        for line in f:
-            l_split = line.split()
-            lines.append(l_split)
-    lines = lines[:-1]
-    for j in lines:
-        number = float(j[0][:-6])
-        exponent = int(j[0][-1])
-        new_number = number * 10**exponent
-        j[0] = new_number
-        j[1] = int(j[1])
-    x = [round(x[0], 3) for x in lines]
-    y = [x[1] for x in lines]
-    return x, y
+        lines = f.read().splitlines()[:-1]
+    x, y = _columns(lines)
+    return np.round(x, 3), y
 
 
-def get_xy_itx(path: str):
-    lines = []
+def read_itx(path: str):
     with open(path, "r") as f:
-        for line in f:
-            lines.append(line)
-    lines = lines[3:-13]
-    x_raw = [i.split(" ")[0] for i in lines]
-    y_raw = [i.split(" ")[1] for i in lines]
-    x = []
-    y = []
-    for j in range(0, len(x_raw)):
-        x_number = float(x_raw[j][:8])
-        x_exponent = int(x_raw[j][-1])
-        y_number = float(y_raw[j][:8])
-        y_exponent = int(y_raw[j][-1])
-        x_new_format = round(x_number * 10**x_exponent, 2)
-        y_new_format = round(y_number * 10**y_exponent, 10)
-        x.append(x_new_format)
-        y.append(y_new_format)
-    return x, y
+        lines = f.read().splitlines()[3:-13]
+    x, y = _columns(lines)
+    return np.round(x, 2), np.round(y, 10)
 
 
-def get_xy_scn(path: str):
-    x = []
-    y = []
+def read_scn(path: str):
     with open(path, "r") as f:
-        for line in f:
-            if len(line.split()) == 2:
-                one_x = float(line.split()[0])
-                one_y = float(line.split()[1])
-                x.append(one_x)
-                y.append(one_y)
-    return x, y
+        lines = [line for line in f if len(line.split()) == 2]
+    return _columns(lines)
+
+
+def read_xrdml(path: str):
+    scans = iter_xrdml_scans(path)
+    try:
+        return next(scans)
+    except StopIteration:
+        raise ValueError("No 2Theta scan found") from None
+    finally:
+        scans.close()
+
+
+def read_xrdml_scans(path: str):
+    return list(iter_xrdml_scans(path))
+
+
+def iter_xrdml_scans(path: str, chunk_size: int = 1 << 20):
+    parser = ET.XMLPullParser(events=("end",))
+    x_axis = None
+    y = None
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset in range(0, len(mm), chunk_size):
+                    parser.feed(mm[offset : offset + chunk_size])
+                    for _, elem in parser.read_events():
+                        tag = elem.tag.rsplit("}", 1)[-1]
+                        if tag == "positions" and elem.get("axis") == "2Theta":
+                            x_axis = _xrdml_positions(elem)
+                        elif tag in ("intensities", "counts"):
+                            y = np.fromstring(elem.text or "", sep=" ")
+                        elif tag == "scan":
+                            if x_axis is not None and y is not None:
+                                yield _xrdml_x(x_axis, len(y)), y
+                            x_axis = None
+                            y = None
+                            elem.clear()
+        parser.close()
+    except ET.ParseError as e:
+        raise ValueError(f"Malformed XRDML file {path}: {e}") from None
+
+
+def _xrdml_positions(elem):
+    values = {child.tag.rsplit("}", 1)[-1]: child.text for child in elem}
+    if "listPositions" in values:
+        return np.fromstring(values["listPositions"], sep=" ")
+    return float(values["startPosition"]), float(values["endPosition"])
+
+
+def _xrdml_x(x_axis, length: int):
+    if isinstance(x_axis, np.ndarray):
+        return x_axis
+    return np.linspace(x_axis[0], x_axis[1], num=length)
+
+
+def read_ras(path: str):
+    with open(path, "r", encoding="SHIFT_JIS") as f:
+        lines = f.read().splitlines()
+    data_start = _marker_line(lines, "*RAS_INT_START") + 1
+    data_end = _marker_line(lines, "*RAS_INT_END", data_start)
+    return _columns(lines[data_start:data_end])
+
+
+def _marker_line(lines: list, marker: str, start: int = 0):
+    for num in range(start, len(lines)):
+        if marker in lines[num]:
+            return num
+    raise ValueError(f"{marker} not found")
+
+
+ASC_LINE = re.compile(rb"^\s*\d+\.\d+E[+-]\d{4}\s+\d+\s*$", re.MULTILINE)
+SCN_LINE = re.compile(rb"^\s*-?\d+\.?\d*\s+-?\d+\.?\d*\s*$", re.MULTILINE)
+
+register_format("ras", read_ras, lambda head: b"*RAS_" in head)
+register_format(
+    "xrdml",
+    read_xrdml,
+    lambda head: b"<xrdMeasurement" in head or b"<positions axis=" in head,
+)
+register_format("itx", read_itx, lambda head: head.lstrip().startswith(b"IGOR"))
+register_format("asc", read_asc, lambda head: ASC_LINE.search(head) is not None)
+register_format("scn", read_scn, lambda head: SCN_LINE.search(head) is not None)
+
+
+# List based readers kept for the scripts that index into x and y directly
+def get_xy_asc(path: str):
+    x, y = read_asc(path)
+    return x.tolist(), y.astype(int).tolist()
+
+
+def get_xy_itx(path: str):
+    x, y = read_itx(path)
+    return x.tolist(), y.tolist()
+
+
+def get_xy_scn(path: str):
+    x, y = read_scn(path)
+    return x.tolist(), y.tolist()
 
 
 def get_xy_xrdml(path: str):
-    lines = []
-    with open(path, "r") as f:
-        for line in f:
-            lines.append(line)
-    for num, line in enumerate(lines):
-        if '<positions axis="2Theta" unit="deg">' in line:
-            x_start_line = lines[num + 1]
-            x_start = float(
-                x_start_line[x_start_line.find(">") + 1 : x_start_line.find("</")]
-            )
-            x_end_line = lines[num + 2]
-            x_end = float(x_end_line[x_end_line.find(">") + 1 : x_end_line.find("</")])
-        if '<intensities unit="counts">' in line:
-            y_line = lines[num]
-            intensities_string = y_line.split('<intensities unit="counts">')[1].split(
-                "</intensities>"
-            )[0]
-            y = [int(x) for x in intensities_string.split()]
-    x = [float(x_start + i * (x_end - x_start) / (len(y) - 1)) for i in range(len(y))]
-    return x, y
+    x, y = read_xrdml(path)
+    return x.tolist(), y.astype(int).tolist()
 
 
 def get_xy_ras(path: str):
-    lines = []
-    with open(path, "r", encoding="SHIFT_JIS") as f:
-        for line in f:
-            lines.append(line)
-    for num, line in enumerate(lines):
-        if "*RAS_INT_START" in line:
-            data_start = num + 1
-        if "*RAS_INT_END" in line:
-            data_end = num
-    data_lines = lines[data_start:data_end]
-    x = []
-    y = []
-    for data_line in data_lines:
-        split_line = data_line.split(" ")
-        x.append(float(split_line[0]))
-        y.append(float(split_line[1]))
-    return x, y
+    x, y = read_ras(path)
+    return x.tolist(), y.tolist()